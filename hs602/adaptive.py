@@ -0,0 +1,314 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import socket
+import threading
+import time
+from hs602.controller import Controller
+from hs602.ingest import Ingest
+
+
+class Meter(object):
+    """Measure delivered throughput and RTP loss of a stream.
+
+    Packets are fed in by a receiver (or by listen()), samples report
+    the rate and loss since the previous sample. A reordered packet
+    that arrives after a later one takes back the loss its gap counted.
+    A new SSRC, a sequence jump or a run of late packets means the
+    stream restarted, counting starts over at the new sequence number
+    rather than as loss.
+    """
+    def __init__(self, jump=2048, resync=16):
+        """
+        :param jump: Sequence jump treated as a restart - default 2048.
+        :param resync: Late packets in a row treated as a restart -
+        default 16.
+        """
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.expected = 0
+        self.lost = 0
+        self.seq = None
+        self.ssrc = None
+        self.jump = int(jump)
+        self.resync = int(resync)
+        self.late_run = 0
+        # Sequence numbers counted lost that may still arrive late.
+        self.missing = set()
+        self.since = time.monotonic()
+        self.thread = None
+        self.sock = None
+        self.ingest = None
+
+    def count(self, nbytes, expected=0, lost=0):
+        """Count delivered data directly, e.g. RTMP upload stats.
+
+        :param nbytes: Bytes delivered.
+        :param expected: Packets expected.
+        :param lost: Packets lost.
+        """
+        with self.lock:
+            self.bytes += nbytes
+            self.expected += expected
+            self.lost += lost
+
+    def feed(self, data):
+        """Count a received packet, RTP sequence gaps count as loss
+        until the missing packets turn up.
+
+        :param data: Packet data.
+        """
+        expected = lost = 0
+        # RTP version 2 header.
+        if len(data) >= 12 and data[0] >> 6 == 2:
+            seq = data[2] << 8 | data[3]
+            ssrc = bytes(data[8:12])
+            gap = 0 if self.seq is None else (seq - self.seq) & 0xffff
+            if gap >= 0x8000:
+                # Late packets aren't loss, unless there are too many.
+                self.late_run += 1
+                if (0x10000 - gap > self.jump or
+                        self.late_run >= self.resync):
+                    gap = None
+                elif seq in self.missing:
+                    # Reordered, not lost after all.
+                    self.missing.discard(seq)
+                    lost = -1
+            else:
+                self.late_run = 0
+                if gap >= self.jump:
+                    gap = None
+            if self.seq is None or ssrc != self.ssrc or gap is None:
+                # First packet or a restart.
+                expected = 1
+                self.late_run = 0
+                self.missing.clear()
+            elif gap and gap < 0x8000:
+                # Duplicates aren't loss either.
+                expected = gap
+                lost = gap - 1
+                self.missing.update((self.seq + skipped) & 0xffff
+                                    for skipped in range(1, gap))
+                if len(self.missing) > self.jump:
+                    # Too far behind to arrive as anything but a restart.
+                    self.missing = {missing for missing in self.missing
+                                    if (seq - missing) & 0xffff <=
+                                    self.jump}
+            if expected:
+                self.seq = seq
+                self.ssrc = ssrc
+        self.count(len(data), expected, lost)
+
+    def sample(self):
+        """Rate in kbps and loss ratio since the last sample."""
+        with self.lock:
+            now = time.monotonic()
+            elapsed = max(now - self.since, 1e-6)
+            kbps = self.bytes * 8 / 1000 / elapsed
+            # Late arrivals may take back loss from an earlier sample.
+            loss = (max(self.lost, 0) / self.expected if self.expected
+                    else 0.0)
+            self.bytes = self.expected = self.lost = 0
+            self.since = now
+        return kbps, loss
+
+    def listen(self, port=8085, timeout=5, bitrate=None):
+        """Receive the stream on a UDP port in a background thread.
+
+        :param port: Stream receive port - default 8085.
+        :param timeout: Socket timeout - default 5.
+        :param bitrate: (optional) Device bitrate in kbps, sizes the
+        receive buffer.
+        """
+        self.sock = Controller.sock(addr='', port=port, timeout=timeout,
+                                    udp=True)
+        self.ingest = Ingest(self.sock, bitrate)
+        self.thread = threading.Thread(target=self.receive,
+                                       name='hs602-meter', daemon=True)
+        self.thread.start()
+
+    def receive(self):
+        """Receive loop."""
+        sock = self.sock
+        ingest = self.ingest
+        buf = bytearray(65536)
+        view = memoryview(buf)
+        while self.sock is sock:
+            try:
+                size = ingest.recv_into(buf)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.feed(view[:size])
+
+    def close(self):
+        """Stop receiving."""
+        sock, self.sock = self.sock, None
+        # Unconnected UDP, shutdown() would fail before closing it.
+        if sock:
+            sock.close()
+
+
+class Adaptive(object):
+    """Step a device's bitrate to match what is actually delivered.
+
+    A sample is bad when loss is high, or when there is some loss and
+    less than the configured rate arrives, and good when loss is low,
+    anything in between holds. The encoder is VBR and a static scene
+    sends well under its average, so a short rate alone isn't
+    congestion. Several bad samples in a row step the bitrate down,
+    a longer run of good ones steps it back up, and changes are spaced
+    by a cooldown. Optionally fps drops once the bitrate floor is hit.
+    """
+    def __init__(self, controller, meter, low=500, high=20000, down=0.75,
+                 up=1.1, loss_high=0.02, loss_low=0.002, deliver=0.85,
+                 hold_down=2, hold_up=5, cooldown=10, fps=None):
+        """
+        :param controller: Controller to adjust.
+        :param meter: Meter measuring the stream.
+        :param low: Lowest bitrate - default 500.
+        :param high: Highest bitrate - default 20000.
+        :param down: Step down factor - default 0.75.
+        :param up: Step up factor - default 1.1.
+        :param loss_high: Loss ratio that is bad - default 0.02.
+        :param loss_low: Loss ratio that is good - default 0.002.
+        :param deliver: Fraction of the bitrate that must arrive while
+        packets are being lost - default 0.85.
+        :param hold_down: Bad samples before stepping down - default 2.
+        :param hold_up: Good samples before stepping up - default 5.
+        :param cooldown: Seconds between changes - default 10.
+        :param fps: (optional) Low and high fps, e.g. (25, 60), fps is
+        lowered when the bitrate is at its floor.
+        """
+        self.controller = controller
+        self.meter = meter
+        self.low = int(low)
+        self.high = int(high)
+        self.down = float(down)
+        self.up = float(up)
+        self.loss_high = float(loss_high)
+        self.loss_low = float(loss_low)
+        self.deliver = float(deliver)
+        self.hold_down = int(hold_down)
+        self.hold_up = int(hold_up)
+        self.cooldown = float(cooldown)
+        self.fps = fps
+        self.bitrate = None
+        self.reduced = False
+        self.bad = self.good = 0
+        self.changed = 0
+        self.changes = list()
+        self.running = False
+        self.thread = None
+        self.event = threading.Event()
+
+    def set_bitrate(self, bitrate, reason):
+        """Apply a new bitrate.
+
+        :param bitrate: New bitrate.
+        :param reason: Why, kept with the change history.
+        """
+        bitrate = int(min(self.high, max(self.low, bitrate)))
+        if bitrate == self.bitrate:
+            return False
+        self.controller.bitrate(bitrate)
+        self.changes.append((time.time(), 'bitrate', bitrate, reason))
+        self.bitrate = bitrate
+        return True
+
+    def set_fps(self, reduced, reason):
+        """Lower or restore fps.
+
+        :param reduced: Use the low fps.
+        :param reason: Why, kept with the change history.
+        """
+        if not self.fps or reduced == self.reduced:
+            return False
+        fps = self.fps[0] if reduced else self.fps[1]
+        self.controller.fps(fps)
+        self.changes.append((time.time(), 'fps', fps, reason))
+        self.reduced = reduced
+        return True
+
+    def tick(self):
+        """Take a sample and adjust, returns the kbps and loss."""
+        if self.bitrate is None:
+            self.bitrate = int(self.controller.bitrate())
+        kbps, loss = self.meter.sample()
+
+        short = loss > 0 and kbps < self.bitrate * self.deliver
+        if loss > self.loss_high or short:
+            self.bad += 1
+            self.good = 0
+        elif loss < self.loss_low:
+            self.good += 1
+            self.bad = 0
+        else:
+            self.bad = self.good = 0
+
+        now = time.monotonic()
+        if now - self.changed < self.cooldown:
+            return kbps, loss
+
+        reason = '{:.0f}kbps {:.2%} loss'.format(kbps, loss)
+        changed = False
+        if self.bad >= self.hold_down:
+            changed = (self.set_bitrate(self.bitrate * self.down, reason)
+                       or self.set_fps(True, reason))
+        elif self.good >= self.hold_up:
+            changed = (self.set_fps(False, reason)
+                       or self.set_bitrate(self.bitrate * self.up, reason))
+        if changed:
+            self.changed = now
+            self.bad = self.good = 0
+        return kbps, loss
+
+    def run(self, interval):
+        """Adjust loop.
+
+        :param interval: Seconds between samples.
+        """
+        while self.running:
+            if self.event.wait(interval):
+                break
+            try:
+                self.tick()
+            except Exception:
+                # The device may be busy or reconnecting, try again on
+                # the next sample.
+                pass
+
+    def start(self, interval=2):
+        """Start adjusting in a background thread.
+
+        :param interval: Seconds between samples - default 2.
+        """
+        self.running = True
+        self.event.clear()
+        self.meter.sample()
+        self.thread = threading.Thread(target=self.run, args=(interval,),
+                                       name='hs602-adaptive',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop adjusting."""
+        self.running = False
+        self.event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,151 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Capability name and a test of the firmware version string.
+RULES = {
+    # Version 56 of the firmware doesn't support channel name.
+    'name': lambda firmware: not firmware.startswith('56'),
+}
+
+
+def default_path():
+    """Default cache file, under XDG_CACHE_HOME or ~/.cache."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'hs602', 'capabilities.json')
+
+
+class Capabilities(object):
+    """What each device's firmware supports, probed once.
+
+    Results are kept per firmware version and each device's firmware is
+    remembered, optionally on disk, so a restart doesn't probe the fleet
+    again. A device's firmware is re-read after max_age in case it was
+    upgraded.
+    """
+    def __init__(self, path=None, max_age=86400):
+        """
+        :param path: (optional) Cache file, None keeps it in memory, see
+        default_path().
+        :param max_age: Seconds before a device's firmware is checked
+        again - default 86400.
+        """
+        self.path = path
+        self.max_age = float(max_age)
+        self.lock = threading.Lock()
+        self.firmwares = dict()
+        self.devices = dict()
+        if path:
+            self.load()
+
+    def load(self):
+        """Read the cache file, a missing or corrupt file is ignored."""
+        try:
+            with open(self.path) as src:
+                data = json.load(src)
+            self.firmwares = dict(data.get('firmwares', {}))
+            self.devices = dict(data.get('devices', {}))
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def save(self):
+        """Write the cache file, best-effort - a cache that can't be
+        written is only kept in memory."""
+        if not self.path:
+            return
+        with self.lock:
+            data = json.dumps({'firmwares': self.firmwares,
+                               'devices': self.devices}, sort_keys=True)
+        directory = os.path.dirname(self.path) or os.curdir
+        tmp = None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # Each writer has its own file, the last replace wins.
+            fd, tmp = tempfile.mkstemp(
+                prefix='.{}.'.format(os.path.basename(self.path)),
+                suffix='.tmp', dir=directory)
+            with os.fdopen(fd, 'w') as out:
+                out.write(data)
+            os.replace(tmp, self.path)
+            tmp = None
+        except OSError:
+            pass
+        finally:
+            if tmp:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def probe(firmware):
+        """Capabilities of a firmware version.
+
+        :param firmware: Firmware version string.
+        """
+        return {name: bool(test(firmware)) for name, test in RULES.items()}
+
+    def get(self, controller, refresh=False):
+        """Capabilities of a controller's device.
+
+        :param controller: Controller of the device.
+        :param refresh: Read the firmware version again.
+        """
+        key = '{}:{}'.format(controller.addr, controller.tcp)
+        with self.lock:
+            device = self.devices.get(key)
+            fresh = (device and not refresh and
+                     time.time() - device['checked'] < self.max_age)
+            if fresh and device['firmware'] in self.firmwares:
+                return self.firmwares[device['firmware']]
+
+        # Probe outside the lock, other devices needn't wait on this one.
+        firmware = controller.firmware()
+        with self.lock:
+            caps = self.firmwares.get(firmware)
+            if caps is None or set(caps) != set(RULES):
+                caps = self.firmwares[firmware] = self.probe(firmware)
+            self.devices[key] = {'firmware': firmware,
+                                 'checked': time.time()}
+        self.save()
+        return caps
+
+    def supports(self, controller, capability):
+        """Does a controller's device support a capability, unknown
+        capabilities are assumed supported.
+
+        :param controller: Controller of the device.
+        :param capability: Capability name.
+        """
+        if capability not in RULES:
+            return True
+        return self.get(controller).get(capability, True)
+
+    def forget(self, controller):
+        """Drop what's known about a device, e.g. after an upgrade.
+
+        :param controller: Controller of the device.
+        """
+        key = '{}:{}'.format(controller.addr, controller.tcp)
+        with self.lock:
+            self.devices.pop(key, None)
+        self.save()
@@ -0,0 +1,249 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import errno
+import os
+import socket
+import threading
+import time
+from hs602.controller import Controller
+
+
+class Capture(object):
+    """Record a TCP mode stream to a file.
+
+    With TCP mode set the device pushes its stream to our listen port.
+    Where the kernel supports it the bytes are spliced from the socket
+    through a pipe into the file without passing through Python
+    (sendfile needs a file as its source, so it doesn't apply here),
+    otherwise they're copied through one reused buffer.
+
+    A device that reboots may never close its old connection, so a new
+    connection replaces the one being recorded and TCP keepalive drops
+    a peer that has gone away.
+    """
+    def __init__(self, path, port=8085, host='', zerocopy=True,
+                 chunk=1 << 20, idle=10):
+        """
+        :param path: File to append the stream to.
+        :param port: Stream receive port - default 8085.
+        :param host: Address to listen on - default all.
+        :param zerocopy: Use splice where available - default True.
+        :param chunk: Bytes moved per call - default 1MiB.
+        :param idle: Seconds of silence before the peer is probed, it's
+        dropped after about twice this without an answer - default 10.
+        """
+        self.path = str(path)
+        self.port = Controller.port(port)
+        self.host = str(host)
+        self.zerocopy = bool(zerocopy) and hasattr(os, 'splice')
+        self.chunk = int(chunk)
+        self.idle = max(int(idle), 1)
+        self.pumper = None
+        self.method = None
+        self.bytes = 0
+        self.connections = 0
+        self.started = None
+        self.server = None
+        self.conn = None
+        self.thread = None
+        self.running = False
+        self.error = None
+
+    def rate(self):
+        """Average kbps since the capture started."""
+        if not self.started:
+            return 0.0
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return self.bytes * 8 / 1000 / elapsed
+
+    def splice(self, conn, fd):
+        """Move bytes socket to pipe to file inside the kernel, returns
+        False if splice isn't usable for these descriptors.
+
+        :param conn: Accepted socket.
+        :param fd: File descriptor.
+        """
+        flags = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(
+            os, 'SPLICE_F_MORE', 0)
+        rd, wr = os.pipe()
+        try:
+            try:
+                import fcntl
+                fcntl.fcntl(wr, getattr(fcntl, 'F_SETPIPE_SZ', 1031),
+                            self.chunk)
+            except (ImportError, OSError):
+                pass
+            first = True
+            while self.running:
+                try:
+                    size = os.splice(conn.fileno(), wr, self.chunk,
+                                     flags=flags)
+                except OSError as exc:
+                    if first and exc.errno in (errno.EINVAL,
+                                               errno.ENOSYS):
+                        return False
+                    raise
+                first = False
+                if not size:
+                    break
+                while size:
+                    moved = os.splice(rd, fd, size, flags=flags)
+                    size -= moved
+                    self.bytes += moved
+            return True
+        finally:
+            os.close(rd)
+            os.close(wr)
+
+    def copy(self, conn, fd):
+        """Copy bytes through a reused buffer.
+
+        :param conn: Accepted socket.
+        :param fd: File descriptor.
+        """
+        buf = bytearray(self.chunk)
+        view = memoryview(buf)
+        while self.running:
+            size = conn.recv_into(buf)
+            if not size:
+                break
+            pos = 0
+            while pos < size:
+                pos += os.write(fd, view[pos:size])
+            self.bytes += size
+
+    def pump(self, conn):
+        """Record one connection until it closes.
+
+        :param conn: Accepted socket.
+        """
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            # splice refuses O_APPEND files, seek to the end instead.
+            os.lseek(fd, 0, os.SEEK_END)
+            if self.zerocopy:
+                self.method = 'splice'
+                if self.splice(conn, fd):
+                    return
+                self.zerocopy = False
+            self.method = 'copy'
+            self.copy(conn, fd)
+        finally:
+            os.close(fd)
+
+    def keepalive(self, conn):
+        """Probe an idle connection so a vanished peer is dropped.
+
+        :param conn: Accepted socket.
+        """
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        interval = max(self.idle // 3, 1)
+        for name, value in (('TCP_KEEPIDLE', self.idle),
+                            ('TCP_KEEPINTVL', interval),
+                            ('TCP_KEEPCNT', 3),
+                            # Unacknowledged data, in milliseconds.
+                            ('TCP_USER_TIMEOUT', self.idle * 2000)):
+            option = getattr(socket, name, None)
+            if option is None:
+                continue
+            try:
+                conn.setsockopt(socket.IPPROTO_TCP, option, value)
+            except OSError:
+                pass
+
+    def record(self, conn, previous):
+        """Record a connection once the one it replaced has stopped.
+
+        :param conn: Accepted socket.
+        :param previous: Thread recording the replaced connection.
+        """
+        if previous:
+            previous.join()
+        try:
+            self.pump(conn)
+        except OSError as exc:
+            # Expected when replaced.
+            if self.conn is conn:
+                self.error = exc
+        finally:
+            if self.conn is conn:
+                self.conn = None
+            Controller.socket_shutdown(conn)
+
+    def run(self):
+        """Accept loop, the device reconnects if the stream restarts."""
+        while self.running:
+            try:
+                conn, addr = self.server.accept()
+            except OSError:
+                break
+            # Blocking, splice can't wait on a socket with a timeout.
+            conn.settimeout(None)
+            self.keepalive(conn)
+            # The new connection wins, wake the old one's recorder.
+            old, self.conn = self.conn, conn
+            if old is not None:
+                try:
+                    old.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.connections += 1
+            if self.started is None:
+                self.started = time.monotonic()
+            self.pumper = threading.Thread(
+                target=self.record, args=(conn, self.pumper),
+                name='hs602-capture-pump', daemon=True)
+            self.pumper.start()
+
+    def start(self):
+        """Listen and record in a background thread."""
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.host, self.port))
+        server.listen(1)
+        self.server = server
+        self.running = True
+        self.thread = threading.Thread(target=self.run,
+                                       name='hs602-capture', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop recording."""
+        self.running = False
+        Controller.socket_shutdown(self.server)
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        conn = self.conn
+        if conn is not None:
+            # The recorder closes it once woken.
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.pumper:
+            self.pumper.join()
+            self.pumper = None
+
+    def stats(self):
+        """Byte counters and the method in use."""
+        return {
+            'bytes': self.bytes,
+            'kbps': self.rate(),
+            'connections': self.connections,
+            'method': self.method,
+        }
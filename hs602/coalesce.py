@@ -0,0 +1,189 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import gettext
+import threading
+import time
+from concurrent.futures import Future, wait
+
+gettext.install('hs602_controller')
+
+FIELDS = ('brightness', 'contrast', 'hue', 'saturation')
+
+
+class Pending(object):
+    """A value waiting to be written and the futures waiting on it."""
+    def __init__(self, value, due):
+        self.value = value
+        self.due = due
+        self.futures = list()
+
+
+class Coalescer(object):
+    """Collapse rapid sets of a field into one write of the latest value.
+
+    Sets return at once with a Future. A field's value is written once
+    the debounce window since its first unsent set has passed and no
+    earlier write is in flight, sets arriving meanwhile replace the value
+    and every future waiting on it completes with what was written. The
+    writer thread exits once nothing is pending and is started again by
+    the next set.
+    """
+    def __init__(self, controller, window=0.05, fields=FIELDS):
+        """
+        :param controller: Controller to write to.
+        :param window: Seconds to gather sets before writing - default
+        0.05.
+        :param fields: Controller setters that may be coalesced - default
+        brightness, contrast, hue and saturation.
+        """
+        self.controller = controller
+        self.window = float(window)
+        self.fields = tuple(fields)
+        self.cond = threading.Condition()
+        self.pending = dict()
+        # Pending being written.
+        self.writing = None
+        self.thread = None
+        self.running = True
+        self.sets = 0
+        self.writes = 0
+
+    def set(self, field, value):
+        """Set a field, returns a Future of the value written.
+
+        :param field: Field name, e.g. brightness.
+        :param value: New value.
+        """
+        field = str(field).lower()
+        if field not in self.fields:
+            raise Exception(_('unknown field {}, must be one of: '
+                              '{}').format(field, list(self.fields)))
+        future = Future()
+        with self.cond:
+            if not self.running:
+                raise Exception(_('coalescer is closed'))
+            pending = self.pending.get(field)
+            if pending is None:
+                pending = self.pending[field] = Pending(
+                    value, time.monotonic() + self.window)
+            pending.value = value
+            pending.futures.append(future)
+            self.sets += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='hs602-coalesce',
+                                               daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return future
+
+    def brightness(self, new_value):
+        """Set brightness, see set()."""
+        return self.set('brightness', new_value)
+
+    def contrast(self, new_value):
+        """Set contrast, see set()."""
+        return self.set('contrast', new_value)
+
+    def hue(self, new_value):
+        """Set hue, see set()."""
+        return self.set('hue', new_value)
+
+    def saturation(self, new_value):
+        """Set saturation, see set()."""
+        return self.set('saturation', new_value)
+
+    def take(self):
+        """Wait for the next due field, returns it and its Pending or
+        None once drained."""
+        with self.cond:
+            while True:
+                if not self.pending:
+                    # Idle, the next set starts a new thread.
+                    self.thread = None
+                    return None
+                field = min(self.pending,
+                            key=lambda name: self.pending[name].due)
+                left = self.pending[field].due - time.monotonic()
+                # Closing writes what's left without waiting.
+                if left <= 0 or not self.running:
+                    pending = self.writing = self.pending.pop(field)
+                    return field, pending
+                self.cond.wait(left)
+
+    def run(self):
+        """Write loop, one write at a time."""
+        while True:
+            item = self.take()
+            if item is None:
+                return
+            field, pending = item
+            futures = [future for future in pending.futures
+                       if future.set_running_or_notify_cancel()]
+            # Everyone waiting gave up, nothing to write.
+            if not futures:
+                with self.cond:
+                    self.writing = None
+                continue
+            try:
+                value = getattr(self.controller, field)(pending.value)
+            except Exception as exc:
+                with self.cond:
+                    self.writing = None
+                for future in futures:
+                    future.set_exception(exc)
+                continue
+            with self.cond:
+                self.writes += 1
+                self.writing = None
+            for future in futures:
+                future.set_result(value)
+
+    def flush(self, timeout=None):
+        """Wait for pending writes, returns False on timeout.
+
+        :param timeout: (optional) Seconds to wait.
+        """
+        with self.cond:
+            pending = list(self.pending.values())
+            if self.writing:
+                pending.append(self.writing)
+            futures = [future for item in pending for future in item.futures]
+        done, not_done = wait(futures, timeout)
+        return not not_done
+
+    def close(self, wait=True):
+        """Write what's pending and stop.
+
+        :param wait: Wait for the writes - default True.
+        """
+        with self.cond:
+            self.running = False
+            thread = self.thread
+            self.cond.notify()
+        # A write that fails may close us from the writer thread.
+        if wait and thread and thread is not threading.current_thread():
+            thread.join()
+
+    def stats(self):
+        """Sets received and writes made."""
+        with self.cond:
+            return {
+                'sets': self.sets,
+                'writes': self.writes,
+                'pending': len(self.pending),
+            }
@@ -16,6 +16,15 @@
 # along with hs602.  If not, see <http://www.gnu.org/licenses/>.
 import socket
 import gettext
+import threading
+import time
+from contextlib import contextmanager
+from hs602.capability import Capabilities
+from hs602.coalesce import Coalescer
+from hs602.deadline import Deadline, DeadlineExceeded, remaining
+from hs602.flight import Flight
+from hs602.priority import PriorityLock, classify
+from hs602.state import DeviceState
 
 gettext.install('hs602_controller')
 
@@ -23,7 +32,7 @@ gettext.install('hs602_controller')
 class Controller(object):
     """Controller for HS602-based devices."""
     def __init__(self, addr=None, tcp=8087, udp=8086, listen=8085,
-                 timeout=10, cmd_len=15):
+                 timeout=10, cmd_len=15, capabilities=None):
         """
         :param addr: Address of device.
         :param tcp: TCP command port - default 8087.
@@ -31,6 +40,8 @@ class Controller(object):
         :param listen: Stream receive port - default 8085.
         :param timeout: Socket timeout - default 10.
         :param cmd_len: Server-defined command length - default 15.
+        :param capabilities: (optional) Capabilities cache, may be shared
+        by controllers and kept on disk - default in memory.
         """
         self.addr = str(addr)
         self.tcp = int(tcp)
@@ -39,6 +50,20 @@ class Controller(object):
         self.timeout = int(timeout)
         self.cmd_len = int(cmd_len)
         self.socket = None
+        # Commands are serialised by wire, most urgent first, not by
+        # lock, which only guards the field lock table and coalescer.
+        self.wire = PriorityLock()
+        self.lock = threading.RLock()
+        # Monotonic time of the last successful exchange.
+        self.last = 0
+        # Deadlines active on each thread, see within().
+        self.local = threading.local()
+        # Identical concurrent reads share one flight, see shared().
+        self.flight = Flight()
+        self.fields = dict()
+        self.capabilities = capabilities or Capabilities()
+        # Created on first use, see coalesce().
+        self.coalescer = None
 
     @staticmethod
     def str(value):
@@ -121,7 +146,9 @@ class Controller(object):
         :param udp: Create a UDP socket - will bind automatically.
         """
         port = __class__.port(port)
-        timeout = __class__.int(timeout)
+        # Fractions of a second are kept, e.g. to fit a deadline.
+        __class__.int(timeout)
+        timeout = max(float(timeout), 0.001)
 
         try:
             if udp:
@@ -200,6 +227,15 @@ class Controller(object):
                     break
         return replies
 
+    @staticmethod
+    def knock(addr):
+        """Knock message that opens the command port.
+
+        :param addr: IPv4 address of device.
+        """
+        ip = reversed(__class__.str(addr).split('.'))
+        return [67] + [int(octal) for octal in ip]
+
     @staticmethod
     def discover(encoding='utf-8', ping='HS602', pong='YES',
                  broadcast='<broadcast>', udp=8086):
@@ -225,18 +261,143 @@ class Controller(object):
             raise Exception('discovery failure') from exc
         return [rep[0] for rep in ret if rep[2] == pong]
 
-    def shutdown(self):
-        """Shutdown."""
+    def disconnect(self):
+        """Drop the session, the next command will knock and
+        reconnect."""
         __class__.socket_shutdown(self.socket)
+        self.socket = None
+
+    def shutdown(self):
+        """Shutdown, the next command will knock and reconnect."""
+        self.disconnect()
+        # Pending colour writes are still sent in the background,
+        # coalesce() starts afresh.
+        coalescer, self.coalescer = getattr(self, 'coalescer', None), None
+        if coalescer:
+            coalescer.close(wait=False)
 
     __del__ = shutdown
 
-    def cmd(self, msg, new=False):
+    @contextmanager
+    def within(self, deadline=None):
+        """Run commands on this thread within a deadline, yields it.
+
+        Every command sent inside the block is limited to the time left
+        and fails with DeadlineExceeded once it is spent or cancelled.
+
+        :param deadline: Deadline or seconds, None to inherit.
+        """
+        deadline = Deadline.make(deadline)
+        deadlines = getattr(self.local, 'deadlines', None)
+        if deadlines is None:
+            deadlines = self.local.deadlines = list()
+        if deadline is None:
+            yield deadlines[-1] if deadlines else None
+            return
+        deadlines.append(deadline)
+        try:
+            yield deadline
+        finally:
+            deadlines.remove(deadline)
+
+    def field_lock(self, field):
+        """Lock ordering reads and writes of a field.
+
+        :param field: Field name.
+        """
+        with self.lock:
+            lock = self.fields.get(field)
+            if not lock:
+                lock = self.fields[field] = threading.RLock()
+            return lock
+
+    def shared(self, field, func, *args):
+        """Read a field, concurrent identical reads share one call.
+
+        Each caller waits within its own deadlines, if the call fails on
+        another caller's deadline it is run again.
+
+        :param field: Field name.
+        :param func: Callable that reads the field.
+        :param args: Callable args.
+        """
+        def read():
+            with self.field_lock(field):
+                return func(*args)
+        deadlines = list(getattr(self.local, 'deadlines', None) or [])
+        return self.flight.do(field, read, deadlines=deadlines)
+
+    def invalidate(self, *fields):
+        """Stop new readers joining reads already in flight.
+
+        :param fields: Field names, settings is always included.
+        """
+        for field in fields + ('settings',):
+            self.flight.forget(field)
+
+    @contextmanager
+    def barrier(self, field):
+        """Write a field, readers arriving meanwhile wait for it.
+
+        :param field: Field name.
+        """
+        self.invalidate(field)
+        with self.field_lock(field):
+            try:
+                yield
+            finally:
+                # Reads started during the write are stale too.
+                self.invalidate(field)
+
+    def supports(self, capability):
+        """Does the device's firmware support a capability, probed once
+        per firmware version, see Capabilities.
+
+        :param capability: Capability name, e.g. name.
+        """
+        return self.capabilities.supports(self, capability)
+
+    @contextmanager
+    def turn(self, priority, deadlines=()):
+        """Hold the session for a frame, waiting no longer than the
+        deadlines allow.
+
+        :param priority: Priority class, see hs602.priority.
+        :param deadlines: Deadlines of the command.
+        """
+        limit = remaining(deadlines)
+        for deadline in deadlines:
+            deadline.hook(self.wire.wake)
+        try:
+            acquired = self.wire.acquire(
+                priority, limit,
+                lambda: any(deadline.cancelled for deadline in deadlines))
+        finally:
+            for deadline in deadlines:
+                deadline.unhook(self.wire.wake)
+        if not acquired:
+            remaining(deadlines)
+            raise DeadlineExceeded(_('deadline exceeded'))
+        try:
+            yield
+        finally:
+            self.wire.release()
+
+    def cmd(self, msg, new=False, priority=None):
         """Send command.
 
+        Commands wait their turn by priority class, control (keepalive,
+        streaming, mode) ahead of telemetry ahead of bulk RTMP strings.
+
         :param msg: Command message.
         :param new: Force new socket.
+        :param priority: (optional) Priority class, see hs602.priority -
+        default by command.
         """
+        deadlines = list(getattr(self.local, 'deadlines', None) or [])
+        for deadline in deadlines:
+            deadline.check()
+
         msg = __class__.bytes(msg)
         data_len = self.cmd_len
         addr = __class__.str(self.addr)
@@ -245,252 +406,238 @@ class Controller(object):
         timeout = __class__.int(self.timeout)
 
         addr = socket.gethostbyname(addr)
-        ip = reversed(addr.split('.'))
-        knock = [67] + [int(octal) for octal in ip]
+        knock = __class__.knock(addr)
+        if priority is None:
+            priority = classify(msg)
 
-        # Do we require a new socket?
-        if not self.socket or new:
+        with self.turn(priority, deadlines):
+            # Do we require a new socket?
+            if not self.socket or new:
+                try:
+                    # Knock.
+                    self.udp_msg(addr=addr, port=udp, msg=knock,
+                                 reply=False)
+                except Exception as exc:
+                    raise Exception(_('failed to knock')) from exc
+
+                # Connect within what's left of the deadlines.
+                self.disconnect()
+                try:
+                    self.socket = __class__.sock(
+                        addr=addr, port=tcp,
+                        timeout=remaining(deadlines, timeout))
+                except Exception as exc:
+                    for deadline in deadlines:
+                        if deadline.expired():
+                            try:
+                                deadline.check()
+                            except DeadlineExceeded as dexc:
+                                raise dexc from exc
+                    raise
+                self.socket.settimeout(timeout)
+
+            # Wake a blocked command if a deadline is cancelled.
+            sock = self.socket
+
+            def abort():
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+            if deadlines:
+                limit = remaining(deadlines, timeout)
+                for deadline in deadlines:
+                    deadline.hook(abort)
+                sock.settimeout(max(limit, 0.001))
+            data = bytes()
+            sent = 0
             try:
-                # Knock.
-                self.udp_msg(addr=addr, port=udp, msg=knock,
-                             reply=False)
-            except Exception as exc:
-                raise Exception(_('failed to knock')) from exc
-
-            # Connect!
-            self.shutdown()
-            self.socket = __class__.sock(addr=addr, port=tcp,
-                                         timeout=timeout)
-        data = bytes()
-        sent = 0
-        while True:
-            # Send!
-            if msg:
-                sent = self.socket.send(msg[:self.cmd_len])
-                if not sent > 0:
-                    __class__.socket_shutdown(self.socket)
-                    raise OSError(_('send failed'))
-                msg = msg[sent:]
-                continue
-
-            # Receive reply.
-            buf = self.socket.recv(1024)
-            if not buf:
-                __class__.socket_shutdown(self.socket)
-                raise OSError(_('receive failed'))
-            data += buf
-            # Return the response.
-            if len(data) >= data_len:
-                return data
+                while True:
+                    # Send!
+                    if msg:
+                        sent = self.socket.send(msg[:self.cmd_len])
+                        if not sent > 0:
+                            raise OSError(_('send failed'))
+                        msg = msg[sent:]
+                        continue
+
+                    # Receive reply.
+                    buf = self.socket.recv(1024)
+                    if not buf:
+                        raise OSError(_('receive failed'))
+                    data += buf
+                    # Return the response.
+                    if len(data) >= data_len:
+                        self.last = time.monotonic()
+                        return data
+            except OSError as exc:
+                # The session is dead, drop it.
+                self.disconnect()
+                for deadline in deadlines:
+                    if deadline.expired():
+                        try:
+                            deadline.check()
+                        except DeadlineExceeded as dexc:
+                            raise dexc from exc
+                raise
+            finally:
+                for deadline in deadlines:
+                    deadline.unhook(abort)
+                if deadlines and self.socket is sock:
+                    sock.settimeout(timeout)
+
+    def drive(self, op):
+        """Run an operation on this session, returns its result.
+
+        :param op: Operation generator, see OPERATIONS.
+        """
+        try:
+            frame = next(op)
+            while True:
+                try:
+                    reply = self.cmd(frame)
+                except Exception as exc:
+                    # Let the operation attach what it has so far.
+                    frame = op.throw(exc)
+                else:
+                    frame = op.send(reply)
+        except StopIteration as stop:
+            return stop.value
+
+    def write(self, field, op):
+        """Run an operation that sets a field, readers of the field wait
+        for it and only see the new value, see barrier().
+
+        :param field: Field name.
+        :param op: Operation generator.
+        """
+        with self.barrier(field):
+            return self.drive(op)
 
     def led(self):
         """Flash LED."""
-        cmd = [55, 0, 1]
-        cmd = __class__.pad(cmd, self.cmd_len)
-        return __class__.echo(cmd, self.cmd(cmd))
+        return self.drive(led_op(self.cmd_len))
 
     def hdcp(self):
         """HDCP (High-bandwidth Digital Content Protection) state."""
-        cmd = [5, 1]
-        cmd = __class__.pad(cmd, self.cmd_len)
-        return bool(self.cmd(cmd)[0] & 255)
+        return self.drive(hdcp_op(self.cmd_len))
 
     def firmware(self):
         """Firmware version."""
-        ret = self.cmd(__class__.pad([56, 1], self.cmd_len))
-        major, minor, revision = [
-            ret[0] & 255,
-            ret[1] & 255,
-            ret[2] & 255
-        ]
-        return '{}.{}.{}'.format(major, minor, revision)
+        return self.shared('firmware', self._firmware)
+
+    def _firmware(self):
+        """Firmware version, see firmware()."""
+        return self.drive(firmware_op(self.cmd_len))
 
     def clients(self):
         """Client ID and total connected clients. """
-        ret = self.cmd(__class__.pad([50, 1], self.cmd_len))
-        return ret[0] & 255, ret[1] & 255
+        return self.drive(clients_op(self.cmd_len))
 
     def resolution(self):
         """Current input resolution."""
-        resolutions = {
-            0: '1920x1080 60Hz',
-            1: '1280x720 60Hz',
-            2: '720x480 60Hz',
-            3: '720x480 60Hz',
-            4: '720x480 60Hz',
-            5: '1920x1080 50Hz',
-            6: '1280x720 50Hz',
-            7: '720x576 50Hz',
-            8: '720x576 50Hz',
-            9: '720x576 50Hz',
-            10: '1920x1080 60Hz',
-            11: '1280x720 60Hz',
-            12: '720x480 60Hz',
-            13: '720x480 60Hz',
-            14: '1920x1080 50Hz',
-            15: '1280x720 50Hz',
-            16: '720x576 50Hz',
-            17: '720x576 50Hz',
-            18: '720x480 60Hz',
-            19: '720x576 50Hz',
-            20: '1920x1080 25Hz',
-            21: '1920x1080 30Hz',
-            22: '0x0 60Hz',
-            23: '640x480 60Hz',
-            24: '1920x1080 30Hz',
-            25: '1920x1080 25Hz',
-            26: '1920x1080 50Hz',
-            27: '1920x1080 60Hz',
-            28: '1920x1080 24Hz',
-            29: '1920x1080 60Hz',
-            30: '1920x1080 50Hz',
-            31: '1920x1080 24Hz',
-            32: '800x600 60Hz',
-            33: '1024x768 60Hz',
-            34: '1152x864 60Hz',
-            35: '1280x768 60Hz',
-            36: '1280x800 60Hz',
-            37: '1280x960 60Hz',
-            38: '1280x1024 60Hz',
-            39: '1360x768 60Hz',
-            40: '1440x900 60Hz',
-            41: '1600x900 60Hz',
-            42: '1680x1050 60Hz',
-        }
-        ret = self.cmd(__class__.pad([4, 1], self.cmd_len))[0] & 255
-        if not resolutions.get(ret):
-            raise Exception(_('server returned unknown resolution'))
-        return resolutions.get(ret)
+        return self.drive(resolution_op(self.cmd_len))
 
     def keepalive(self):
         """Send keepalive message"""
-        cmd = __class__.pad([0], self.cmd_len)
-        return __class__.echo(cmd, self.cmd(cmd))
+        return self.drive(keepalive_op(self.cmd_len))
 
     def source(self, hdmi=None):
         """Get/Set source input - HDMI or Analogue.
 
         :param hdmi: True for HDMI, False for analogue.
         """
-        # Get.
-        ret = self.cmd(__class__.pad([1, 1], self.cmd_len))[0] & 255
-        if ret not in [2, 3]:
-            raise Exception(_('server returned invalid source id'))
+        if hdmi is None:
+            return self.drive(source_op(self.cmd_len))
+        return self.write('source', source_op(self.cmd_len, hdmi))
 
-        ret = 'hdmi' if ret == 3 else 'analogue'
-
-        # Set.
-        if hdmi is not None:
-            cmd = [1, 0, 2]
-            if hdmi:
-                cmd = [1, 0, 3]
-
-            cmd = __class__.pad(cmd, self.cmd_len)
-            self.cmd(cmd)
-            return self.source()
+    def rtmp(self, option, new_value=None, deadline=None):
+        """Get/Set RTMP option.
 
-        return ret
+        :param option: One of: url, key, username or password.
+        :param new_value: New value.
+        :param deadline: (optional) Deadline or seconds for the whole
+        read/write, DeadlineExceeded carries the partial value.
+        """
+        with self.within(deadline):
+            return self._rtmp(option, new_value)
 
-    def rtmp(self, option, new_value=None):
-        """Get/Set RTMP option.
+    def _rtmp(self, option, new_value=None):
+        """Get/Set RTMP option, see rtmp().
 
         :param option: One of: url, key, username or password.
         :param new_value: New value.
         """
-        options = {
-            'url': 16,
-            'key': 17,
-            'username': 20,
-            'password': 21,
-            'name': 23,
-        }
-        # What's the option?
-        orig_opt = str(option).lower()
-        option = options.get(orig_opt, None)
-        if not option:
-            raise Exception(_('unknown rtmp option {}, must be one of: '
-                              '{}').format(orig_opt,
-                                           list(options.keys())))
+        option = str(option).lower()
+        # Skip what the firmware doesn't support.
+        if option in RTMP_OPTIONS and not self.supports(option):
+            return ''
+
         # Get.
-        cmd = [option, 1]
-        buf = ret = ''
-        for pos in range(0, 255):
-            dec = int(self.cmd(cmd + [pos])[0] & 255)
-            if not dec:
-                break
-            buf += chr(dec)
-        ret = buf
-
-        if new_value:
-            cmd = [option, 0]
-            # Is what we're setting too long?
-            __class__.str(new_value)
-            for pos, char in enumerate(new_value):
-                char_cmd = __class__.pad(cmd + [pos, ord(char)],
-                                         self.cmd_len)
-                if not __class__.echo(char_cmd, self.cmd(char_cmd)):
-                    raise Exception(_('server rejected rtmp {} new '
-                                      'value at char '
-                                      '{}').format(orig_opt, char))
-
-            # Has the server accepted the new value?
-            cmd = __class__.pad(cmd + [len(new_value), 0], self.cmd_len)
-            if not __class__.echo(cmd, self.cmd(cmd)):
-                raise Exception(_('server rejected new rtmp {} value'
-                                  '{}').format(orig_opt, new_value))
-            ret = str(new_value)
-
-        # Done!
-        return ret
-
-    def url(self, new_value=None):
+        if not new_value:
+            return self.shared(option, self._rtmp_get, option)
+
+        # Set, readers of this option wait for the new value.
+        with self.barrier(option):
+            return self.drive(rtmp_op(self.cmd_len, option, new_value))
+
+    def _rtmp_get(self, option):
+        """Read an RTMP option a character at a time.
+
+        :param option: Option name.
+        """
+        return self.drive(rtmp_op(self.cmd_len, option))
+
+    def url(self, new_value=None, deadline=None):
         """Get/Set RTMP URL.
 
         :param new_value: URL to set.
+        :param deadline: (optional) Deadline or seconds.
         """
         if new_value is not None:
-            return self.rtmp('url', new_value)
-        return self.rtmp('url')
+            return self.rtmp('url', new_value, deadline=deadline)
+        return self.rtmp('url', deadline=deadline)
 
-    def key(self, new_value=None):
+    def key(self, new_value=None, deadline=None):
         """Get/Set RTMP key.
 
         :param new_value: Key to set.
+        :param deadline: (optional) Deadline or seconds.
         """
         if new_value is not None:
-            return self.rtmp('key', new_value)
-        return self.rtmp('key')
+            return self.rtmp('key', new_value, deadline=deadline)
+        return self.rtmp('key', deadline=deadline)
 
-    def username(self, new_value=None):
+    def username(self, new_value=None, deadline=None):
         """Get/Set RTMP username.
 
         :param new_value: Username to set.
+        :param deadline: (optional) Deadline or seconds.
         """
         if new_value is not None:
-            return self.rtmp('username', new_value)
-        return self.rtmp('username')
+            return self.rtmp('username', new_value, deadline=deadline)
+        return self.rtmp('username', deadline=deadline)
 
-    def password(self, new_value=None):
+    def password(self, new_value=None, deadline=None):
         """Get/Set RTMP password.
 
         :param new_value: Password to set.
+        :param deadline: (optional) Deadline or seconds.
         """
         if new_value is not None:
-            return self.rtmp('password', new_value)
-        return self.rtmp('password')
+            return self.rtmp('password', new_value, deadline=deadline)
+        return self.rtmp('password', deadline=deadline)
 
-    def name(self, new_value=None):
+    def name(self, new_value=None, deadline=None):
         """Get/Set RTMP channel name.
 
         :param new_value: RTMP name to set.
+        :param deadline: (optional) Deadline or seconds.
         """
-        # Version 56 of the firmware doesn't support channel name.
-        if self.firmware().startswith('56'):
-            return ''
-
         if new_value is not None:
-            return self.rtmp('name', new_value)
-        return self.rtmp('name')
+            return self.rtmp('name', new_value, deadline=deadline)
+        return self.rtmp('name', deadline=deadline)
 
     def colour(self, option, new_value=None):
         """Get/Set a colour value.
@@ -499,33 +646,10 @@ class Controller(object):
         hue or saturation.
         :param new_value: New colour value - 0 - 255
         """
-        options = {
-            'brightness': 0,
-            'contrast': 1,
-            'hue': 2,
-            'saturation': 3,
-        }
-        orig_opt = str(option).lower()
-        option = options.get(orig_opt, None)
-        if option is None:
-            raise Exception(_('unknown colour option {}, must be one '
-                              'of: {}').format(orig_opt,
-                                               list(options.keys())))
-
-        # Get colour value.
-        ret = int(self.cmd([10, 1, option])[0] & 255)
-
-        # Set new colour value.
-        if new_value is not None:
-            __class__.int(new_value)
-            cmd = __class__.pad([10, 0, option, new_value],
-                                self.cmd_len)
-            if not __class__.echo(cmd, self.cmd(cmd)):
-                raise Exception(_('server rejected new {} value {}')
-                                .format(orig_opt, new_value))
-            ret = int(new_value)
-
-        return ret
+        if new_value is None:
+            return self.drive(colour_op(self.cmd_len, option))
+        return self.write(str(option).lower(),
+                          colour_op(self.cmd_len, option, new_value))
 
     def brightness(self, new_value=None):
         """Get/Set brightness.
@@ -563,6 +687,22 @@ class Controller(object):
             return self.colour('saturation', new_value)
         return self.colour('saturation')
 
+    def coalesce(self, window=None):
+        """Coalescer for interactive colour controls, rapid sets are
+        collapsed into one write of the latest value. The same one is
+        returned until shutdown(), so call this for each set.
+
+        :param window: (optional) Seconds to gather sets before writing -
+        default 0.05.
+        """
+        with self.lock:
+            if self.coalescer is None:
+                self.coalescer = Coalescer(
+                    self, 0.05 if window is None else window)
+            elif window is not None:
+                self.coalescer.window = float(window)
+            return self.coalescer
+
     def picture(self, new_value=None):
         """Get/Set RTMP output picture size.
 
@@ -571,121 +711,18 @@ class Controller(object):
 
         This is width by height.
         """
-        w_range = range(0, 1921)
-        h_range = range(0, 1081)
-        ret_value = orig_val = ''
-
-        # Get the picture width/height.
-        ret = self.cmd(__class__.pad([3, 1], self.cmd_len))
-
-        height = (
-            ret[0] & 255 +
-            (ret[1] & 255) << 8 +
-            (ret[2] & 255) << 16 +
-            (ret[3] & 255) << 24
-        )
-        width = (
-            ret[4] & 255 +
-            (ret[5] & 255) << 8 +
-            (ret[6] & 255) << 16 +
-            (ret[7] & 255) << 24
-        )
-
-        if width not in w_range or height not in h_range:
-            raise Exception(_('server returned invalid values - '
-                              'width {} height {}').format(width,
-                                                           height))
-        ret_value = '{},{}'.format(width, height)
-
-        # Set the value.
-        if new_value is not None:
-            # Try a string split.
-            try:
-                new_value = new_value.replace(" ", "")
-                orig_val = new_value
-                new_value = new_value.split(',', 2)
-            except AttributeError:
-                pass
-
-            try:
-                width = int(new_value[0].strip())
-                height = int(new_value[1].strip())
-                if width not in w_range or height not in h_range:
-                    raise ValueError
-            except (TypeError, IndexError, ValueError) as exc:
-                raise Exception(_('invalid width or height, max width '
-                                  '1920, height 1080 - set as two  '
-                                  'values e.g, "1920,1080"')) from exc
-
-            height = [
-                height & 255,
-                (height >> 8) & 255,
-                (height >> 16) & 255,
-                (height >> 24) & 255,
-            ]
-            width = [
-                width & 255,
-                (width >> 8) & 255,
-                (width >> 16) & 255,
-                (width >> 24) & 255,
-            ]
-            cmd = __class__.pad([3, 0] + width + height, self.cmd_len)
-            # Server accepted?
-            if not __class__.echo(cmd, self.cmd(cmd)):
-                raise Exception(_('server rejected new picture size '
-                                  '{}').format(orig_val))
-            ret_value = orig_val
-
-        # Done
-        return ret_value
+        if new_value is None:
+            return self.drive(picture_op(self.cmd_len))
+        return self.write('picture', picture_op(self.cmd_len, new_value))
 
     def bitrate(self, new_value=None):
         """Get/Set the average RTMP bitrate.
 
         :param new_value: New average bitrate - 500 - 20000.
         """
-        # Get value.
-        ret = self.cmd(__class__.pad([2, 1]))
-        onezero = (ret[1] & 255) << 8 | (ret[0] & 255)
-        twothree = (ret[2] & 255) << 16 | (ret[3] & 255) << 24
-        ret_val = onezero | twothree
-
-        if new_value is not None:
-            try:
-                average = int(new_value)
-                if average not in range(500, 20001):
-                    raise ValueError
-            except (TypeError, ValueError):
-                average = 20000
-            low = int(average * 7 / 10)
-            high = int(average * 13 / 10)
-
-            average = [
-                average & 255,
-                (average >> 8) & 255,
-                (average >> 16) & 255,
-                (average >> 24) & 255,
-            ]
-            low = [
-                low & 255,
-                (low >> 8) & 255,
-                (low >> 16) & 255,
-                (low >> 24) & 255,
-            ]
-            high = [
-                high & 255,
-                (high >> 8) & 255,
-                (high >> 16) & 255,
-                (high >> 24) & 255,
-            ]
-            cmd = __class__.pad([2, 0] + average + low + high,
-                                self.cmd_len)
-
-            if not __class__.echo(cmd, self.cmd(cmd)):
-                raise Exception(_('server rejected new bitrate '
-                                  '{}').format(new_value))
-            ret_val = new_value
-        return ret_val
+        if new_value is None:
+            return self.drive(bitrate_op(self.cmd_len))
+        return self.write('bitrate', bitrate_op(self.cmd_len, new_value))
 
     def streaming(self, toggle=False):
         """Get/Set RTMP stream state.
@@ -693,96 +730,63 @@ class Controller(object):
         :param toggle: Set to toggle RTMP streaming state.
 
         """
-        # Get current value.
-        cmd = __class__.pad([15, 1], self.cmd_len)
-        ret = bool(self.cmd(cmd)[0] & 255)
-
-        if toggle:
-            cmd = __class__.pad([15, 0], self.cmd_len)
-            if not __class__.echo(cmd, self.cmd(cmd)):
-                raise Exception(_('server rejected toggling stream '
-                                  'state'))
-            return self.streaming()
-        return ret
+        if not toggle:
+            return self.drive(streaming_op(self.cmd_len))
+        return self.write('streaming', streaming_op(self.cmd_len, toggle))
 
     def fps(self, new_value=None):
         """Get/Set RTMP frames-per-second.
 
         :param new_value: New frames-per-second value, 1 - 60.
         """
-        # Get!
-        ret = self.cmd(__class__.pad([19, 1], self.cmd_len))[0] & 255
-
-        # Set!
-        if new_value is not None:
-            __class__.int(new_value)
-            if new_value not in range(1, 61):
-                new_value = 60
-            new_value = round(int(new_value))
-            fps = [
-                new_value & 255,
-                (new_value >> 8) & 255,
-                (new_value >> 16) & 255,
-                (new_value >> 24) & 255,
-            ]
-
-            cmd = __class__.pad([19, 0] + fps, self.cmd_len)
-            ret = self.cmd(cmd)
-
-            if not __class__.echo(cmd, ret):
-                raise Exception(_('server rejected new fps {}')
-                                .format(new_value))
-            return new_value
-
-        return ret
+        if new_value is None:
+            return self.drive(fps_op(self.cmd_len))
+        return self.write('fps', fps_op(self.cmd_len, new_value))
 
     def mode(self, new_value=None):
         """Get/Set RTP/UDP stream mode.
 
         :param new_value: New stream mode: unicast, broadcast, tcp.
         """
-
-        modes = ['unicast', 'broadcast', 'tcp']
-
-        # Get.
-        mode = self.cmd(__class__.pad([8, 1], self.cmd_len))[0] & 255
-        ret = modes[mode]
-
-        # Set.
-        if new_value is not None:
-            new_value = __class__.str(new_value).lower()
-            orig_val = new_value
-            try:
-                new_value = modes.index(new_value)
-            except ValueError as exc:
-                raise ValueError(_('unknown stream mode - supported '
-                                   'modes: {}'.format(modes))) from exc
-            cmd = __class__.pad([8, 0, new_value], self.cmd_len)
-
-            if not __class__.echo(cmd, self.cmd(cmd)):
-                raise Exception(_('server rejected new stream mode {}')
-                                .format(orig_val))
-            return orig_val
-        return ret
+        if new_value is None:
+            return self.drive(mode_op(self.cmd_len))
+        return self.write('mode', mode_op(self.cmd_len, new_value))
 
     def base_port(self, new_value):
         """Set device base port.
 
         :param new_value: New base port number.
         """
-        port = __class__.port(new_value)
-        cmd = bytes([14, 0]) + port.to_bytes(2, byteorder='little')
-        cmd = __class__.pad(cmd, self.cmd_len)
-        return __class__.echo(cmd, self.cmd(cmd))
+        return self.write('base_port',
+                          base_port_op(self.cmd_len, new_value))
 
-    def settings(self, **kwargs):
+    def settings(self, deadline=None, **kwargs):
         """Get all/Set settings.
 
+        :param deadline: (optional) Deadline or seconds for the whole
+        operation, DeadlineExceeded carries the settings gathered so far.
         :param kwargs: (optional) keyword args [with values] to update.
 
         The passed keyword args should be class method names, for
         example settings(fps=60, username=demo ...)
         """
+        with self.within(deadline):
+            if not kwargs:
+                return self.shared('settings', self._settings)
+            return self._settings(**kwargs)
+
+    def state(self, deadline=None):
+        """Get all settings as a DeviceState snapshot.
+
+        :param deadline: (optional) Deadline or seconds.
+        """
+        return DeviceState.from_settings(self.settings(deadline=deadline))
+
+    def _settings(self, **kwargs):
+        """Get all/Set settings, see settings().
+
+        :param kwargs: (optional) keyword args [with values] to update.
+        """
         read_only_methods = [
             'resolution',
             'clients',
@@ -806,7 +810,8 @@ class Controller(object):
             'name',
             'source',
         ]
-        modifiable = read_only = {}
+        modifiable = dict()
+        read_only = dict()
 
         for method_name in read_only_methods + modifiable_methods:
             method_name = '{}'.format(method_name).lower()
@@ -819,12 +824,16 @@ class Controller(object):
             except KeyError:
                 pass
 
-            # Read only methods do not accept a value.
-            if method_name in read_only_methods:
-                read_only[method_name] = method()
-                continue
+            try:
+                # Read only methods do not accept a value.
+                if method_name in read_only_methods:
+                    read_only[method_name] = method()
+                    continue
 
-            modifiable[method_name] = method(value)
+                modifiable[method_name] = method(value)
+            except DeadlineExceeded as exc:
+                exc.partial = read_only, modifiable
+                raise
 
         # Add misc keys & values.
         read_only.update({
@@ -836,3 +845,499 @@ class Controller(object):
             'len': self.cmd_len,
         })
         return read_only, modifiable
+
+
+# Operations, each a generator that yields command frames, is sent the
+# replies and returns the parsed result. Controller runs them on its
+# session with drive(), Engine runs many at once without blocking.
+
+RESOLUTIONS = {
+    0: '1920x1080 60Hz',
+    1: '1280x720 60Hz',
+    2: '720x480 60Hz',
+    3: '720x480 60Hz',
+    4: '720x480 60Hz',
+    5: '1920x1080 50Hz',
+    6: '1280x720 50Hz',
+    7: '720x576 50Hz',
+    8: '720x576 50Hz',
+    9: '720x576 50Hz',
+    10: '1920x1080 60Hz',
+    11: '1280x720 60Hz',
+    12: '720x480 60Hz',
+    13: '720x480 60Hz',
+    14: '1920x1080 50Hz',
+    15: '1280x720 50Hz',
+    16: '720x576 50Hz',
+    17: '720x576 50Hz',
+    18: '720x480 60Hz',
+    19: '720x576 50Hz',
+    20: '1920x1080 25Hz',
+    21: '1920x1080 30Hz',
+    22: '0x0 60Hz',
+    23: '640x480 60Hz',
+    24: '1920x1080 30Hz',
+    25: '1920x1080 25Hz',
+    26: '1920x1080 50Hz',
+    27: '1920x1080 60Hz',
+    28: '1920x1080 24Hz',
+    29: '1920x1080 60Hz',
+    30: '1920x1080 50Hz',
+    31: '1920x1080 24Hz',
+    32: '800x600 60Hz',
+    33: '1024x768 60Hz',
+    34: '1152x864 60Hz',
+    35: '1280x768 60Hz',
+    36: '1280x800 60Hz',
+    37: '1280x960 60Hz',
+    38: '1280x1024 60Hz',
+    39: '1360x768 60Hz',
+    40: '1440x900 60Hz',
+    41: '1600x900 60Hz',
+    42: '1680x1050 60Hz',
+}
+RTMP_OPTIONS = {
+    'url': 16,
+    'key': 17,
+    'username': 20,
+    'password': 21,
+    'name': 23,
+}
+COLOUR_OPTIONS = {
+    'brightness': 0,
+    'contrast': 1,
+    'hue': 2,
+    'saturation': 3,
+}
+MODES = ['unicast', 'broadcast', 'tcp']
+
+
+def le32(value):
+    """Little-endian bytes of a 32-bit value.
+
+    :param value: Value to split.
+    """
+    return [
+        value & 255,
+        (value >> 8) & 255,
+        (value >> 16) & 255,
+        (value >> 24) & 255,
+    ]
+
+
+def raw_op(msg):
+    """Send a frame as is, returns the raw reply.
+
+    :param msg: Command message.
+    """
+    return (yield msg)
+
+
+def keepalive_op(cmd_len=15):
+    """Keepalive, see Controller.keepalive().
+
+    :param cmd_len: Command length.
+    """
+    cmd = Controller.pad([0], cmd_len)
+    return Controller.echo(cmd, (yield cmd))
+
+
+def led_op(cmd_len=15):
+    """Flash LED, see Controller.led().
+
+    :param cmd_len: Command length.
+    """
+    cmd = Controller.pad([55, 0, 1], cmd_len)
+    return Controller.echo(cmd, (yield cmd))
+
+
+def hdcp_op(cmd_len=15):
+    """HDCP state, see Controller.hdcp().
+
+    :param cmd_len: Command length.
+    """
+    ret = yield Controller.pad([5, 1], cmd_len)
+    return bool(ret[0] & 255)
+
+
+def firmware_op(cmd_len=15):
+    """Firmware version, see Controller.firmware().
+
+    :param cmd_len: Command length.
+    """
+    ret = yield Controller.pad([56, 1], cmd_len)
+    major, minor, revision = [
+        ret[0] & 255,
+        ret[1] & 255,
+        ret[2] & 255
+    ]
+    return '{}.{}.{}'.format(major, minor, revision)
+
+
+def clients_op(cmd_len=15):
+    """Client ID and total, see Controller.clients().
+
+    :param cmd_len: Command length.
+    """
+    ret = yield Controller.pad([50, 1], cmd_len)
+    return ret[0] & 255, ret[1] & 255
+
+
+def resolution_op(cmd_len=15):
+    """Input resolution, see Controller.resolution().
+
+    :param cmd_len: Command length.
+    """
+    ret = (yield Controller.pad([4, 1], cmd_len))[0] & 255
+    if not RESOLUTIONS.get(ret):
+        raise Exception(_('server returned unknown resolution'))
+    return RESOLUTIONS.get(ret)
+
+
+def source_op(cmd_len=15, hdmi=None):
+    """Get/Set source input, see Controller.source().
+
+    :param cmd_len: Command length.
+    :param hdmi: True for HDMI, False for analogue.
+    """
+    # Get.
+    ret = (yield Controller.pad([1, 1], cmd_len))[0] & 255
+    if ret not in [2, 3]:
+        raise Exception(_('server returned invalid source id'))
+
+    ret = 'hdmi' if ret == 3 else 'analogue'
+
+    # Set.
+    if hdmi is not None:
+        cmd = [1, 0, 2]
+        if hdmi:
+            cmd = [1, 0, 3]
+        yield Controller.pad(cmd, cmd_len)
+        return (yield from source_op(cmd_len))
+
+    return ret
+
+
+def rtmp_op(cmd_len=15, option='url', new_value=None):
+    """Get/Set an RTMP option a character per frame, see
+    Controller.rtmp(). DeadlineExceeded thrown in gains the partial
+    value.
+
+    :param cmd_len: Command length.
+    :param option: One of: url, key, username, password or name.
+    :param new_value: New value.
+    """
+    # What's the option?
+    orig_opt = str(option).lower()
+    option = RTMP_OPTIONS.get(orig_opt, None)
+    if not option:
+        raise Exception(_('unknown rtmp option {}, must be one of: '
+                          '{}').format(orig_opt,
+                                       list(RTMP_OPTIONS.keys())))
+    # Get.
+    cmd = [option, 1]
+    buf = ''
+    try:
+        for pos in range(0, 255):
+            dec = int((yield cmd + [pos])[0] & 255)
+            if not dec:
+                break
+            buf += chr(dec)
+    except DeadlineExceeded as exc:
+        exc.partial = buf
+        raise
+    if not new_value:
+        return buf
+
+    # Set.
+    cmd = [option, 0]
+    # Is what we're setting too long?
+    Controller.str(new_value)
+    for pos, char in enumerate(new_value):
+        char_cmd = Controller.pad(cmd + [pos, ord(char)], cmd_len)
+        try:
+            reply = yield char_cmd
+        except DeadlineExceeded as exc:
+            # Partial is what the server has accepted.
+            exc.partial = new_value[:pos]
+            raise
+        if not Controller.echo(char_cmd, reply):
+            raise Exception(_('server rejected rtmp {} new '
+                              'value at char '
+                              '{}').format(orig_opt, char))
+
+    # Has the server accepted the new value?
+    cmd = Controller.pad(cmd + [len(new_value), 0], cmd_len)
+    if not Controller.echo(cmd, (yield cmd)):
+        raise Exception(_('server rejected new rtmp {} value'
+                          '{}').format(orig_opt, new_value))
+    return str(new_value)
+
+
+def colour_op(cmd_len=15, option='brightness', new_value=None):
+    """Get/Set a colour value, see Controller.colour().
+
+    :param cmd_len: Command length.
+    :param option: One of: brightness, contrast, hue or saturation.
+    :param new_value: New colour value - 0 - 255.
+    """
+    orig_opt = str(option).lower()
+    option = COLOUR_OPTIONS.get(orig_opt, None)
+    if option is None:
+        raise Exception(_('unknown colour option {}, must be one '
+                          'of: {}').format(orig_opt,
+                                           list(COLOUR_OPTIONS.keys())))
+
+    # Get colour value.
+    if new_value is None:
+        return int((yield [10, 1, option])[0] & 255)
+
+    # Set new colour value, the echo confirms it without a read.
+    Controller.int(new_value)
+    cmd = Controller.pad([10, 0, option, new_value], cmd_len)
+    if not Controller.echo(cmd, (yield cmd)):
+        raise Exception(_('server rejected new {} value {}')
+                        .format(orig_opt, new_value))
+    return int(new_value)
+
+
+def picture_op(cmd_len=15, new_value=None):
+    """Get/Set RTMP output picture size, see Controller.picture().
+
+    :param cmd_len: Command length.
+    :param new_value: Picture size as "width,height".
+    """
+    w_range = range(0, 1921)
+    h_range = range(0, 1081)
+    ret_value = orig_val = ''
+
+    # Get the picture width/height.
+    ret = yield Controller.pad([3, 1], cmd_len)
+
+    height = (
+        ret[0] & 255 +
+        (ret[1] & 255) << 8 +
+        (ret[2] & 255) << 16 +
+        (ret[3] & 255) << 24
+    )
+    width = (
+        ret[4] & 255 +
+        (ret[5] & 255) << 8 +
+        (ret[6] & 255) << 16 +
+        (ret[7] & 255) << 24
+    )
+
+    if width not in w_range or height not in h_range:
+        raise Exception(_('server returned invalid values - '
+                          'width {} height {}').format(width,
+                                                       height))
+    ret_value = '{},{}'.format(width, height)
+
+    # Set the value.
+    if new_value is not None:
+        # Try a string split.
+        try:
+            new_value = new_value.replace(" ", "")
+            orig_val = new_value
+            new_value = new_value.split(',', 2)
+        except AttributeError:
+            pass
+
+        try:
+            width = int(new_value[0].strip())
+            height = int(new_value[1].strip())
+            if width not in w_range or height not in h_range:
+                raise ValueError
+        except (TypeError, IndexError, ValueError) as exc:
+            raise Exception(_('invalid width or height, max width '
+                              '1920, height 1080 - set as two  '
+                              'values e.g, "1920,1080"')) from exc
+
+        cmd = Controller.pad([3, 0] + le32(width) + le32(height), cmd_len)
+        # Server accepted?
+        if not Controller.echo(cmd, (yield cmd)):
+            raise Exception(_('server rejected new picture size '
+                              '{}').format(orig_val))
+        ret_value = orig_val
+
+    # Done
+    return ret_value
+
+
+def bitrate_op(cmd_len=15, new_value=None):
+    """Get/Set the average RTMP bitrate, see Controller.bitrate().
+
+    :param cmd_len: Command length.
+    :param new_value: New average bitrate - 500 - 20000.
+    """
+    # Get value.
+    ret = yield Controller.pad([2, 1])
+    onezero = (ret[1] & 255) << 8 | (ret[0] & 255)
+    twothree = (ret[2] & 255) << 16 | (ret[3] & 255) << 24
+    ret_val = onezero | twothree
+
+    if new_value is not None:
+        try:
+            average = int(new_value)
+            if average not in range(500, 20001):
+                raise ValueError
+        except (TypeError, ValueError):
+            average = 20000
+        low = int(average * 7 / 10)
+        high = int(average * 13 / 10)
+
+        cmd = Controller.pad([2, 0] + le32(average) + le32(low) +
+                             le32(high), cmd_len)
+
+        if not Controller.echo(cmd, (yield cmd)):
+            raise Exception(_('server rejected new bitrate '
+                              '{}').format(new_value))
+        ret_val = new_value
+    return ret_val
+
+
+def streaming_op(cmd_len=15, toggle=False):
+    """Get/Toggle RTMP stream state, see Controller.streaming().
+
+    :param cmd_len: Command length.
+    :param toggle: Toggle the stream state.
+    """
+    # Get current value.
+    ret = bool((yield Controller.pad([15, 1], cmd_len))[0] & 255)
+
+    if toggle:
+        cmd = Controller.pad([15, 0], cmd_len)
+        if not Controller.echo(cmd, (yield cmd)):
+            raise Exception(_('server rejected toggling stream '
+                              'state'))
+        return (yield from streaming_op(cmd_len))
+    return ret
+
+
+def fps_op(cmd_len=15, new_value=None):
+    """Get/Set RTMP frames-per-second, see Controller.fps().
+
+    :param cmd_len: Command length.
+    :param new_value: New frames-per-second value, 1 - 60.
+    """
+    # Get!
+    ret = (yield Controller.pad([19, 1], cmd_len))[0] & 255
+
+    # Set!
+    if new_value is not None:
+        Controller.int(new_value)
+        if new_value not in range(1, 61):
+            new_value = 60
+        new_value = round(int(new_value))
+
+        cmd = Controller.pad([19, 0] + le32(new_value), cmd_len)
+        if not Controller.echo(cmd, (yield cmd)):
+            raise Exception(_('server rejected new fps {}')
+                            .format(new_value))
+        return new_value
+
+    return ret
+
+
+def mode_op(cmd_len=15, new_value=None):
+    """Get/Set stream mode, see Controller.mode().
+
+    :param cmd_len: Command length.
+    :param new_value: New stream mode: unicast, broadcast, tcp.
+    """
+    # Get.
+    mode = (yield Controller.pad([8, 1], cmd_len))[0] & 255
+    ret = MODES[mode]
+
+    # Set.
+    if new_value is not None:
+        new_value = Controller.str(new_value).lower()
+        orig_val = new_value
+        try:
+            new_value = MODES.index(new_value)
+        except ValueError as exc:
+            raise ValueError(_('unknown stream mode - supported '
+                               'modes: {}'.format(MODES))) from exc
+        cmd = Controller.pad([8, 0, new_value], cmd_len)
+
+        if not Controller.echo(cmd, (yield cmd)):
+            raise Exception(_('server rejected new stream mode {}')
+                            .format(orig_val))
+        return orig_val
+    return ret
+
+
+def base_port_op(cmd_len=15, new_value=None):
+    """Set device base port, see Controller.base_port().
+
+    :param cmd_len: Command length.
+    :param new_value: New base port number.
+    """
+    port = Controller.port(new_value)
+    cmd = bytes([14, 0]) + port.to_bytes(2, byteorder='little')
+    cmd = Controller.pad(cmd, cmd_len)
+    return Controller.echo(cmd, (yield cmd))
+
+
+def rtmp_field(option):
+    """Operation for one RTMP option.
+
+    :param option: RTMP option name.
+    """
+    def op(cmd_len=15, new_value=None):
+        return rtmp_op(cmd_len, option, new_value)
+    return op
+
+
+def colour_field(option):
+    """Operation for one colour option.
+
+    :param option: Colour option name.
+    """
+    def op(cmd_len=15, new_value=None):
+        return colour_op(cmd_len, option, new_value)
+    return op
+
+
+# Getter/setter name and its operation, called with the command length
+# then the method's args.
+OPERATIONS = {
+    'keepalive': keepalive_op,
+    'led': led_op,
+    'hdcp': hdcp_op,
+    'firmware': firmware_op,
+    'clients': clients_op,
+    'resolution': resolution_op,
+    'source': source_op,
+    'rtmp': rtmp_op,
+    'url': rtmp_field('url'),
+    'key': rtmp_field('key'),
+    'username': rtmp_field('username'),
+    'password': rtmp_field('password'),
+    'name': rtmp_field('name'),
+    'colour': colour_op,
+    'brightness': colour_field('brightness'),
+    'contrast': colour_field('contrast'),
+    'hue': colour_field('hue'),
+    'saturation': colour_field('saturation'),
+    'picture': picture_op,
+    'bitrate': bitrate_op,
+    'streaming': streaming_op,
+    'fps': fps_op,
+    'mode': mode_op,
+    'base_port': base_port_op,
+}
+
+
+def operation(method, cmd_len=15, *args):
+    """Operation for a getter/setter call.
+
+    :param method: Method name, see OPERATIONS.
+    :param cmd_len: Command length.
+    :param args: Method args.
+    """
+    try:
+        op = OPERATIONS[method]
+    except KeyError:
+        raise KeyError(_('unknown operation {}').format(method)) from None
+    return op(cmd_len, *args)
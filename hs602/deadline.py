@@ -0,0 +1,143 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import gettext
+import threading
+import time
+
+gettext.install('hs602_controller')
+
+
+class DeadlineExceeded(Exception):
+    """Deadline passed or cancelled before an operation finished."""
+    def __init__(self, msg, partial=None, cancelled=False):
+        """
+        :param msg: Error message.
+        :param partial: Result gathered so far.
+        :param cancelled: Was the deadline cancelled.
+        """
+        super().__init__(msg)
+        self.partial = partial
+        self.cancelled = cancelled
+
+
+class Deadline(object):
+    """Time budget shared by every command of an operation.
+
+    A deadline may be cancelled from any thread, a command blocked on
+    the device is woken by shutting its socket down.
+    """
+    def __init__(self, seconds=None):
+        """
+        :param seconds: Budget in seconds, None for no limit.
+        """
+        self.expires = None
+        if seconds is not None:
+            self.expires = time.monotonic() + float(seconds)
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.hooks = list()
+
+    @staticmethod
+    def make(value):
+        """Deadline from a deadline, seconds or None.
+
+        :param value: Value to convert.
+        """
+        if value is None or isinstance(value, Deadline):
+            return value
+        return Deadline(value)
+
+    @property
+    def cancelled(self):
+        """Has the deadline been cancelled."""
+        return self.event.is_set()
+
+    def remaining(self):
+        """Seconds left, None if there's no limit."""
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        """Is the budget spent (or cancelled)."""
+        return self.cancelled or self.remaining() == 0
+
+    def timeout(self, timeout):
+        """Clamp a timeout to the time left.
+
+        :param timeout: Timeout to clamp.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return min(timeout, remaining)
+
+    def check(self, partial=None):
+        """Raise if the budget is spent.
+
+        :param partial: Result gathered so far.
+        """
+        if self.cancelled:
+            raise DeadlineExceeded(_('operation cancelled'), partial,
+                                   cancelled=True)
+        if self.remaining() == 0:
+            raise DeadlineExceeded(_('deadline exceeded'), partial)
+
+    def cancel(self):
+        """Cancel, wakes any command waiting on the device."""
+        with self.lock:
+            self.event.set()
+            hooks = list(self.hooks)
+        for hook in hooks:
+            hook()
+
+    def hook(self, func):
+        """Call func on cancel (now if already cancelled).
+
+        :param func: Callable.
+        """
+        with self.lock:
+            if not self.event.is_set():
+                self.hooks.append(func)
+                return
+        func()
+
+    def unhook(self, func):
+        """Remove a cancel callback.
+
+        :param func: Callable.
+        """
+        with self.lock:
+            try:
+                self.hooks.remove(func)
+            except ValueError:
+                pass
+
+
+def remaining(deadlines, timeout=None):
+    """Seconds left before the first of several deadlines, raises if any
+    is spent or cancelled.
+
+    :param deadlines: Deadlines to check.
+    :param timeout: (optional) Upper limit, None for no limit.
+    """
+    for deadline in deadlines:
+        deadline.check()
+        left = deadline.remaining()
+        if left is not None:
+            timeout = left if timeout is None else min(timeout, left)
+    return timeout
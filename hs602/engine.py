@@ -0,0 +1,371 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import errno
+import selectors
+import socket
+import time
+from collections import deque
+from hs602.controller import Controller, operation, raw_op
+
+
+class Device(object):
+    """Non-blocking command session with one device."""
+    def __init__(self, addr):
+        """
+        :param addr: Address of device.
+        """
+        self.addr = Controller.str(addr)
+        self.ip = None
+        self.sock = None
+        # idle, connecting, sending or receiving.
+        self.state = 'idle'
+        self.ops = deque()
+        # Operation in progress.
+        self.op = None
+        # Frame in progress, resent if a kept session had gone stale.
+        self.frame = None
+        self.out = bytes()
+        self.data = bytes()
+        self.results = list()
+        self.error = None
+        self.expires = None
+        # Session kept from an earlier batch, not yet used by this one.
+        self.kept = False
+
+
+class Engine(object):
+    """Run commands on many devices from one thread.
+
+    Each device has a non-blocking socket driven through knock, connect,
+    send and receive by a selector, so a slow device only holds up its
+    own commands. Sessions stay open between batches, one the device
+    closed while idle is reopened when the next batch first uses it.
+    """
+    def __init__(self, tcp=8087, udp=8086, timeout=10, cmd_len=15):
+        """
+        :param tcp: TCP command port - default 8087.
+        :param udp: UDP knock port - default 8086.
+        :param timeout: Seconds allowed for each step - default 10.
+        :param cmd_len: Server-defined command length - default 15.
+        """
+        self.tcp = Controller.port(tcp)
+        self.udp = Controller.port(udp)
+        self.timeout = float(timeout)
+        self.cmd_len = Controller.int(cmd_len)
+        self.devices = dict()
+        self.selector = selectors.DefaultSelector()
+        self.knocker = None
+
+    def close(self):
+        """Close every session."""
+        for device in self.devices.values():
+            self.drop(device)
+        self.devices.clear()
+        Controller.socket_shutdown(self.knocker)
+        self.knocker = None
+        self.selector.close()
+
+    __del__ = close
+
+    def device(self, addr):
+        """Session for an address.
+
+        :param addr: Address of device.
+        """
+        device = self.devices.get(addr)
+        if not device:
+            device = self.devices[addr] = Device(addr)
+        return device
+
+    def drop(self, device):
+        """Close a device session.
+
+        :param device: Device to drop.
+        """
+        if device.sock:
+            try:
+                self.selector.unregister(device.sock)
+            except (KeyError, ValueError):
+                pass
+            Controller.socket_shutdown(device.sock)
+        device.sock = None
+        device.state = 'idle'
+        device.expires = None
+
+    def fail(self, device, exc):
+        """Abandon a device's batch.
+
+        :param device: Device that failed.
+        :param exc: Exception to report.
+        """
+        self.drop(device)
+        device.error = exc
+        device.frame = None
+        if device.op is not None:
+            device.op.close()
+            device.op = None
+        device.ops.clear()
+
+    def watch(self, device, state, events):
+        """Move a device to a new state.
+
+        :param device: Device to update.
+        :param state: New state.
+        :param events: Selector events to wait on.
+        """
+        device.state = state
+        device.expires = time.monotonic() + self.timeout
+        try:
+            self.selector.modify(device.sock, events, device)
+        except KeyError:
+            self.selector.register(device.sock, events, device)
+
+    def knock(self, device):
+        """Knock and start connecting.
+
+        :param device: Device to connect.
+        """
+        if not self.knocker:
+            self.knocker = Controller.sock(addr='', port=self.udp,
+                                           timeout=1, udp=True)
+            self.knocker.setblocking(False)
+        if not device.ip:
+            device.ip = socket.gethostbyname(device.addr)
+        knock = Controller.bytes(Controller.knock(device.ip))
+        self.knocker.sendto(knock, (device.ip, self.udp))
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
+                             socket.IPPROTO_TCP)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        device.sock = sock
+        ret = sock.connect_ex((device.ip, self.tcp))
+        if ret not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise OSError(ret, _('can\'t connect or bind'))
+        self.watch(device, 'connecting', selectors.EVENT_WRITE)
+
+    def operation(self, item):
+        """Operation for a batch item.
+
+        :param item: Method name, (name, args...) tuple, operation
+        generator or a raw command message.
+        """
+        if isinstance(item, str):
+            return operation(item, self.cmd_len)
+        if isinstance(item, tuple) and item and isinstance(item[0], str):
+            return operation(item[0], self.cmd_len, *item[1:])
+        if hasattr(item, 'send'):
+            return item
+        return raw_op(item)
+
+    def next_frame(self, device, reply=None):
+        """Advance a device's operations to the next frame, returns None
+        once they're all done.
+
+        :param device: Device to advance.
+        :param reply: Reply to the last frame, None to start an operation.
+        """
+        while True:
+            if device.op is None and not device.ops:
+                return None
+            try:
+                if device.op is None:
+                    device.op = self.operation(device.ops.popleft())
+                    reply = None
+                if reply is None:
+                    return next(device.op)
+                return device.op.send(reply)
+            except StopIteration as stop:
+                device.results.append(stop.value)
+            except Exception as exc:
+                # A bad value or reply fails its operation, not the batch.
+                device.results.append(exc)
+            device.op = None
+
+    def send(self, device, reply=None):
+        """Start the next command, if any.
+
+        :param device: Device to send to.
+        :param reply: Reply to the last command.
+        """
+        frame = self.next_frame(device, reply)
+        if frame is None:
+            device.state = 'idle'
+            device.expires = None
+            device.frame = None
+            try:
+                self.selector.unregister(device.sock)
+            except (KeyError, ValueError):
+                pass
+            return
+        device.frame = Controller.bytes(frame)
+        self.resend(device)
+
+    def resend(self, device):
+        """Send the frame in progress from the start.
+
+        :param device: Device to send to.
+        """
+        device.out = device.frame
+        device.data = bytes()
+        self.watch(device, 'sending', selectors.EVENT_WRITE)
+
+    def start(self, device):
+        """Start a device's batch.
+
+        :param device: Device to start.
+        """
+        device.kept = device.sock is not None
+        try:
+            if device.sock:
+                self.send(device)
+            else:
+                self.knock(device)
+        except OSError as exc:
+            self.fail(device, exc)
+
+    def recover(self, device, exc):
+        """Handle a session error, a kept session the device closed while
+        idle is reconnected once and the frame sent again, anything else
+        fails the batch.
+
+        :param device: Device that failed.
+        :param exc: Exception raised.
+        """
+        if not device.kept:
+            self.fail(device, exc)
+            return
+        device.kept = False
+        self.drop(device)
+        try:
+            self.knock(device)
+        except OSError as exc:
+            self.fail(device, exc)
+
+    def step(self, device):
+        """Advance a device that's ready.
+
+        :param device: Device to advance.
+        """
+        if device.state == 'connecting':
+            err = device.sock.getsockopt(socket.SOL_SOCKET,
+                                         socket.SO_ERROR)
+            if err:
+                raise OSError(err, _('can\'t connect or bind'))
+            if device.frame is not None:
+                self.resend(device)
+            else:
+                self.send(device)
+
+        elif device.state == 'sending':
+            sent = device.sock.send(device.out[:self.cmd_len])
+            if not sent > 0:
+                raise OSError(_('send failed'))
+            device.out = device.out[sent:]
+            if not device.out:
+                self.watch(device, 'receiving', selectors.EVENT_READ)
+
+        elif device.state == 'receiving':
+            buf = device.sock.recv(1024)
+            if not buf:
+                raise OSError(_('receive failed'))
+            device.data += buf
+            if len(device.data) >= self.cmd_len:
+                # The session works, later errors are real.
+                device.kept = False
+                self.send(device, device.data)
+
+    def expire(self, now):
+        """Fail devices stuck past their timeout.
+
+        :param now: Current time.
+        """
+        for device in self.devices.values():
+            if device.expires is not None and device.expires <= now:
+                device.expires = None
+                self.fail(device, socket.timeout(_('timed out')))
+
+    def run(self, ops, timeout=None):
+        """Run operations on many devices, returns a dict of address to a
+        list of results, or the exception a device's session failed with.
+
+        Each operation is a Controller getter/setter name, a (name,
+        args...) tuple such as ('fps', 25), an operation generator (see
+        hs602.controller.OPERATIONS) or a raw command message whose
+        result is the raw reply. An operation that fails on a bad value
+        or reply has its exception as its result.
+
+        :param ops: Dict of address to a list of operations (or an
+        iterable of address, operations pairs).
+        :param timeout: (optional) Seconds for the whole batch.
+        """
+        try:
+            ops = ops.items()
+        except AttributeError:
+            pass
+        ends = None if timeout is None else time.monotonic() + timeout
+
+        batch = dict()
+        for addr, items in ops:
+            device = self.device(addr)
+            if addr not in batch:
+                device.results = list()
+                device.error = None
+                batch[addr] = device
+            device.ops.extend(items)
+        batch = list(batch.values())
+        for device in batch:
+            self.start(device)
+
+        while any(device.state != 'idle' for device in batch):
+            now = time.monotonic()
+            if ends is not None and now >= ends:
+                for device in batch:
+                    if device.state != 'idle':
+                        self.fail(device,
+                                  socket.timeout(_('batch timed out')))
+                break
+            wait = [device.expires for device in batch
+                    if device.expires is not None]
+            if ends is not None:
+                wait.append(ends)
+            wait = max(0, min(wait) - now) if wait else None
+
+            for key, events in self.selector.select(wait):
+                device = key.data
+                try:
+                    self.step(device)
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except OSError as exc:
+                    self.recover(device, exc)
+            self.expire(time.monotonic())
+
+        return {device.addr: device.error or device.results
+                for device in batch}
+
+    def broadcast(self, addrs, msgs, timeout=None):
+        """Run the same operations on many devices, see run().
+
+        Operation generators can't be shared, pass names or raw messages.
+
+        :param addrs: Device addresses.
+        :param msgs: Operations.
+        :param timeout: (optional) Seconds for the whole batch.
+        """
+        msgs = list(msgs)
+        return self.run([(addr, msgs) for addr in addrs], timeout)
@@ -16,6 +16,7 @@
 # along with hs602.  If not, see <http://www.gnu.org/licenses/>.
 import time
 from hs602.controller import Controller
+from hs602.keepalive import Scheduler
 
 
 def main(*args):
@@ -135,8 +136,13 @@ def main(*args):
         print('Stream will be available locally on udp/rtp://@:8085.')
 
     device.mode(choice)
+
+    # Keep the session alive, the scheduler can hold any number of
+    # devices open from its one thread.
+    keepalive = Scheduler(interval=5)
+    keepalive.add(device)
+    keepalive.start()
     while True:
-        device.keepalive()
         time.sleep(5)
     # Done.
     input('Goodbye! Press any key to exit.')
@@ -0,0 +1,263 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import itertools
+import multiprocessing
+import pickle
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
+from hs602.controller import Controller
+from hs602.deadline import Deadline
+from hs602.gateway import Gateway
+from hs602.keepalive import Scheduler
+
+# Controller methods a batch may call.
+METHODS = frozenset(Gateway.readable + Gateway.writable +
+                    ['keepalive', 'state'])
+
+
+def shard(addr, shards):
+    """Shard an address belongs to.
+
+    :param addr: Address of device.
+    :param shards: Number of shards.
+    """
+    return zlib.crc32(str(addr).encode('utf-8')) % shards
+
+
+def apply(controller, ops, deadline):
+    """Run one device's operations in order, returns index, ok, value
+    tuples.
+
+    :param controller: Controller to use.
+    :param ops: List of index, method, args tuples.
+    :param deadline: Deadline for the batch.
+    """
+    results = list()
+    for index, method, args in ops:
+        if method not in METHODS:
+            results.append((index, False,
+                            _('unknown method {}').format(method)))
+            continue
+        try:
+            with controller.within(deadline):
+                value = getattr(controller, method)(*args)
+        except Exception as exc:
+            results.append((index, False, str(exc) or type(exc).__name__))
+            # A session that fails won't do better for the rest of
+            # this batch, give its time to the other devices.
+            if controller.socket is None:
+                for skipped in ops[len(results):]:
+                    results.append((skipped[0], False, _('skipped')))
+                break
+            continue
+        # The reply is pickled back, check now rather than lose it.
+        try:
+            pickle.dumps(value)
+        except Exception as exc:
+            results.append((index, False, str(exc) or type(exc).__name__))
+            continue
+        results.append((index, True, value))
+    return results
+
+
+def serve(worker, inbox, outbox, options, threads, keepalive=None):
+    """Worker process loop.
+
+    :param worker: Worker index.
+    :param inbox: Queue of batch id, timeout, ops jobs (None to stop).
+    :param outbox: Connection for batch id, worker, results replies.
+    :param options: Controller keyword args.
+    :param threads: Devices served at once.
+    :param keepalive: (optional) Seconds between keepalives of idle
+    sessions.
+    """
+    controllers = dict()
+    scheduler = None
+    if keepalive:
+        scheduler = Scheduler(interval=keepalive)
+        scheduler.start()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            job = inbox.get()
+            if job is None:
+                break
+            batch, timeout, ops = job
+            deadline = Deadline(timeout)
+
+            devices = OrderedDict()
+            for index, addr, method, args in ops:
+                devices.setdefault(addr, list()).append(
+                    (index, method, args))
+            futures = list()
+            for addr, device_ops in devices.items():
+                controller = controllers.get(addr)
+                if not controller:
+                    controller = controllers[addr] = Controller(
+                        addr, **options)
+                    if scheduler:
+                        scheduler.add(controller)
+                futures.append(pool.submit(apply, controller,
+                                           device_ops, deadline))
+            results = list()
+            for future in futures:
+                results.extend(future.result())
+            outbox.send((batch, worker, results))
+    if scheduler:
+        scheduler.stop()
+    for controller in controllers.values():
+        controller.shutdown()
+
+
+class Fleet(object):
+    """Drive a large fleet from a pool of worker processes.
+
+    Devices are sharded across the workers by address, each worker keeps
+    its sessions open between batches and alive while idle. Batches are split per worker and
+    every operation is bounded by the batch timeout, a worker that still
+    fails to answer is replaced.
+    """
+    def __init__(self, processes=None, threads=8, keepalive=5, **options):
+        """
+        :param processes: Worker processes - default CPU count.
+        :param threads: Devices each worker serves at once - default 8.
+        :param keepalive: Seconds between keepalives, None to disable -
+        default 5.
+        :param options: Controller keyword args, e.g. tcp, timeout.
+        """
+        self.processes = int(processes or multiprocessing.cpu_count())
+        self.threads = int(threads)
+        self.keepalive = keepalive
+        self.options = options
+        self.workers = [None] * self.processes
+        self.inboxes = [None] * self.processes
+        # Each worker replies on its own pipe, replacing one can't
+        # corrupt the others' replies.
+        self.outboxes = [None] * self.processes
+        self.batches = itertools.count()
+        for index in range(self.processes):
+            self.spawn(index)
+
+    def spawn(self, index):
+        """(Re)start a worker.
+
+        :param index: Worker index.
+        """
+        old = self.workers[index]
+        if old is not None and old.is_alive():
+            old.terminate()
+            old.join()
+        if self.outboxes[index] is not None:
+            self.outboxes[index].close()
+        self.inboxes[index] = multiprocessing.Queue()
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        self.outboxes[index] = reader
+        self.workers[index] = multiprocessing.Process(
+            target=serve, name='hs602-fleet-{}'.format(index),
+            args=(index, self.inboxes[index], writer, self.options,
+                  self.threads, self.keepalive),
+            daemon=True)
+        self.workers[index].start()
+        writer.close()
+
+    def close(self):
+        """Stop the workers."""
+        for index, worker in enumerate(self.workers):
+            if worker is None:
+                continue
+            self.inboxes[index].put(None)
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+            self.workers[index] = None
+            self.outboxes[index].close()
+            self.outboxes[index] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def run(self, ops, timeout=30, grace=5):
+        """Run operations across the fleet, returns a list of ok, value
+        tuples in the order given.
+
+        :param ops: Iterable of addr, method, args tuples, e.g.
+        ('10.0.0.2', 'fps', (30,)), args may be omitted, see METHODS.
+        :param timeout: Seconds for the whole batch - default 30.
+        :param grace: Seconds to wait on a worker past the timeout before
+        replacing it - default 5.
+        """
+        shards = dict()
+        count = 0
+        for index, op in enumerate(ops):
+            addr, method = op[0], str(op[1])
+            args = tuple(op[2]) if len(op) > 2 else ()
+            shards.setdefault(shard(addr, self.processes), list()).append(
+                (index, addr, method, args))
+            count = index + 1
+
+        batch = next(self.batches)
+        for worker, worker_ops in shards.items():
+            self.inboxes[worker].put((batch, timeout, worker_ops))
+
+        results = [(False, _('timed out'))] * count
+        waiting = set(shards)
+        ends = time.monotonic() + timeout + grace
+        dead = set()
+        while waiting:
+            left = ends - time.monotonic()
+            ready = wait([self.outboxes[worker] for worker in waiting],
+                         max(left, 0))
+            if not ready:
+                break
+            for conn in ready:
+                worker = self.outboxes.index(conn)
+                try:
+                    reply, worker, replies = conn.recv()
+                except (EOFError, OSError):
+                    # The worker died.
+                    waiting.discard(worker)
+                    dead.add(worker)
+                    continue
+                # Late replies from an earlier batch are dropped.
+                if reply != batch:
+                    continue
+                for index, ok, value in replies:
+                    results[index] = (ok, value)
+                waiting.discard(worker)
+
+        for worker in waiting | dead:
+            self.spawn(worker)
+        return results
+
+    def call(self, addr, method, *args, timeout=30):
+        """Run one operation, returns its value or raises.
+
+        :param addr: Address of device.
+        :param method: Controller method name, see METHODS.
+        :param args: Method args.
+        :param timeout: Seconds allowed - default 30.
+        """
+        ok, value = self.run([(addr, method, args)], timeout)[0]
+        if not ok:
+            raise Exception(value)
+        return value
+
@@ -0,0 +1,121 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import threading
+from hs602.deadline import DeadlineExceeded, remaining
+
+
+class Call(object):
+    """An in-flight call."""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.done = False
+        self.value = None
+        self.error = None
+
+    def finish(self, value=None, error=None):
+        """Record the result and wake the callers waiting on it.
+
+        :param value: Result.
+        :param error: Exception raised instead.
+        """
+        with self.cond:
+            self.value = value
+            self.error = error
+            self.done = True
+            self.cond.notify_all()
+
+    def wake(self):
+        """Wake waiting callers to check their own deadlines."""
+        with self.cond:
+            self.cond.notify_all()
+
+    def wait(self, deadlines=()):
+        """Wait for the result within the caller's own deadlines.
+
+        :param deadlines: Caller's Deadlines, DeadlineExceeded is raised
+        once any is spent or cancelled.
+        """
+        for deadline in deadlines:
+            deadline.hook(self.wake)
+        try:
+            with self.cond:
+                while not self.done:
+                    self.cond.wait(remaining(deadlines))
+        finally:
+            for deadline in deadlines:
+                deadline.unhook(self.wake)
+
+
+class Flight(object):
+    """Share one in-flight call between identical concurrent callers.
+
+    The first caller for a key runs the call, callers arriving while it
+    runs wait for it and receive the same result (or exception). Each
+    caller waits only as long as its own deadlines allow, and a leader
+    that runs out of time or is cancelled doesn't fail the others, one
+    of them runs the call again instead.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = dict()
+
+    def do(self, key, func, *args, deadlines=(), **kwargs):
+        """Call func, or join an identical call already running.
+
+        :param key: Key identifying the call.
+        :param func: Callable.
+        :param args: Callable args.
+        :param deadlines: (optional) Caller's Deadlines, bounds waiting on
+        another caller's call.
+        :param kwargs: Callable keyword args.
+        """
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = Call()
+            if leader:
+                break
+
+            call.wait(deadlines)
+            if call.error is None:
+                return call.value
+            # The leader's deadline isn't ours, run it again.
+            if not isinstance(call.error, DeadlineExceeded):
+                raise call.error
+
+        value = error = None
+        try:
+            value = func(*args, **kwargs)
+            return value
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            self.forget(key, call)
+            call.finish(value, error)
+
+    def forget(self, key, call=None):
+        """Stop new callers joining a call, they start a fresh one.
+
+        :param key: Key identifying the call.
+        :param call: (optional) Only forget this call.
+        """
+        with self.lock:
+            if call is None or self.calls.get(key) is call:
+                self.calls.pop(key, None)
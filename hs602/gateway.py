@@ -0,0 +1,303 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from hs602.capability import Capabilities, default_path
+from hs602.controller import Controller
+from hs602.flight import Flight
+from hs602.keepalive import Scheduler
+
+
+class Gateway(object):
+    """Share one session per device between many clients.
+
+    Reads are served from a short-lived cache and identical concurrent
+    reads are merged into one device round trip, writes go straight to
+    the device and invalidate its cached reads.
+    """
+    readable = [
+        'resolution',
+        'clients',
+        'firmware',
+        'hdcp',
+        'mode',
+        'fps',
+        'streaming',
+        'bitrate',
+        'picture',
+        'saturation',
+        'hue',
+        'contrast',
+        'brightness',
+        'username',
+        'password',
+        'key',
+        'url',
+        'name',
+        'source',
+        'settings',
+    ]
+    writable = [
+        'mode',
+        'fps',
+        'streaming',
+        'bitrate',
+        'picture',
+        'saturation',
+        'hue',
+        'contrast',
+        'brightness',
+        'username',
+        'password',
+        'key',
+        'url',
+        'name',
+        'source',
+        'led',
+    ]
+    # Not readable unless asked for, the gateway has no authentication.
+    secrets = [
+        'password',
+        'key',
+    ]
+
+    def __init__(self, devices, ttl=2, keepalive=5, secrets=False,
+                 **options):
+        """
+        :param devices: Addresses of the devices to serve.
+        :param ttl: Seconds a read is cached - default 2.
+        :param keepalive: Seconds between keepalives, None to disable -
+        default 5.
+        :param secrets: Allow reading the RTMP password and key - default
+        False.
+        :param options: Controller keyword args, e.g. tcp, timeout.
+        """
+        self.ttl = float(ttl)
+        self.expose = bool(secrets)
+        if not self.expose:
+            self.readable = [name for name in __class__.readable
+                             if name not in __class__.secrets]
+        self.controllers = {str(addr): Controller(addr, **options)
+                            for addr in devices}
+        self.cache = dict()
+        # Bumped by each write, reads started before it aren't cached.
+        self.generation = dict.fromkeys(self.controllers, 0)
+        self.lock = threading.Lock()
+        self.flight = Flight()
+        self.scheduler = None
+        if keepalive:
+            self.scheduler = Scheduler(interval=keepalive)
+            for controller in self.controllers.values():
+                self.scheduler.add(controller)
+            self.scheduler.start()
+
+    def close(self):
+        """Close every session."""
+        if self.scheduler:
+            self.scheduler.stop()
+        for controller in self.controllers.values():
+            controller.shutdown()
+
+    def controller(self, addr):
+        """Controller for an address.
+
+        :param addr: Address of device.
+        """
+        try:
+            return self.controllers[addr]
+        except KeyError:
+            raise KeyError(_('unknown device {}').format(addr)) from None
+
+    def get(self, addr, method):
+        """Read a value.
+
+        :param addr: Address of device.
+        :param method: Getter name.
+        """
+        if method not in self.readable:
+            raise KeyError(_('unknown getter {}').format(method))
+        controller = self.controller(addr)
+        key = (addr, method)
+        with self.lock:
+            cached = self.cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        return self.flight.do(key, self.read, key, controller, method)
+
+    def read(self, key, controller, method):
+        """Read a value from the device and cache it.
+
+        :param key: Cache key.
+        :param controller: Controller to read.
+        :param method: Getter name.
+        """
+        with self.lock:
+            generation = self.generation[key[0]]
+        value = getattr(controller, method)()
+        if method == 'settings' and not self.expose:
+            read_only, modifiable = value
+            value = read_only, {name: item
+                                for name, item in modifiable.items()
+                                if name not in self.secrets}
+        with self.lock:
+            if self.generation[key[0]] == generation:
+                self.cache[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def set(self, addr, method, value=None):
+        """Write a value.
+
+        :param addr: Address of device.
+        :param method: Setter name.
+        :param value: New value.
+        """
+        if method not in self.writable:
+            raise KeyError(_('unknown setter {}').format(method))
+        controller = self.controller(addr)
+        # Readers arriving from now on must not join a stale read, nor
+        # once it's written join one started meanwhile.
+        for name in (method, 'settings'):
+            self.flight.forget((addr, name))
+        try:
+            if method == 'led':
+                return controller.led()
+            return getattr(controller, method)(value)
+        finally:
+            for name in (method, 'settings'):
+                self.flight.forget((addr, name))
+            with self.lock:
+                self.generation[addr] += 1
+                for key in [key for key in self.cache if key[0] == addr]:
+                    del self.cache[key]
+
+
+class Handler(BaseHTTPRequestHandler):
+    """HTTP/JSON front end, GET /<addr>/<getter> reads and
+    POST /<addr>/<setter> with {"value": ...} writes."""
+    gateway = None
+
+    def reply(self, code, body):
+        """Send a JSON reply.
+
+        :param code: HTTP status.
+        :param body: Object to encode.
+        """
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self):
+        """Address and method from the path."""
+        parts = [part for part in self.path.split('?')[0].split('/')
+                 if part]
+        if len(parts) != 2:
+            return None, None
+        return parts
+
+    def handle_call(self, func, *args):
+        """Call the gateway and reply.
+
+        :param func: Gateway method.
+        :param args: Method args.
+        """
+        try:
+            self.reply(200, {'value': func(*args)})
+        except KeyError as exc:
+            self.reply(404, {'error': str(exc.args[0])})
+        except Exception as exc:
+            self.reply(502, {'error': str(exc) or type(exc).__name__})
+
+    def do_GET(self):
+        addr, method = self.route()
+        if not addr:
+            self.reply(200, {'devices': sorted(self.gateway.controllers)})
+            return
+        self.handle_call(self.gateway.get, addr, method)
+
+    def do_POST(self):
+        addr, method = self.route()
+        if not addr:
+            self.reply(404, {'error': _('not found')})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length).decode('utf-8')
+                              or '{}')
+            value = body.get('value')
+        except (ValueError, AttributeError):
+            self.reply(400, {'error': _('invalid json body')})
+            return
+        self.handle_call(self.gateway.set, addr, method, value)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server."""
+    daemon_threads = True
+
+
+def serve(gateway, host='127.0.0.1', port=8602):
+    """Serve a gateway over HTTP until interrupted.
+
+    :param gateway: Gateway to serve.
+    :param host: Address to listen on - default 127.0.0.1.
+    :param port: Port to listen on - default 8602.
+    """
+    handler = type('Handler', (Handler,), {'gateway': gateway})
+    server = Server((host, port), handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        gateway.close()
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(
+        description='HS602 HTTP/JSON control gateway.')
+    parser.add_argument('devices', nargs='*',
+                        help='device addresses, discovered if omitted')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8602)
+    parser.add_argument('--ttl', type=float, default=2,
+                        help='seconds reads are cached')
+    parser.add_argument('--secrets', action='store_true',
+                        help='allow reading the RTMP password and key')
+    parser.add_argument('--capabilities', default=default_path(),
+                        help='capability cache file, empty to disable')
+    opts = parser.parse_args()
+
+    devices = opts.devices or Controller.discover()
+    if not devices:
+        raise Exception(_('no devices found'))
+    capabilities = Capabilities(opts.capabilities or None)
+    serve(Gateway(devices, ttl=opts.ttl, secrets=opts.secrets,
+                  capabilities=capabilities),
+          opts.host, opts.port)
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
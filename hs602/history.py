@@ -0,0 +1,319 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import gettext
+import struct
+import sys
+import threading
+import time
+from array import array
+
+gettext.install('hs602_controller')
+
+# Field typecodes and the value stored when a sample is missing.
+FIELDS = {
+    'bitrate': ('I', 0xffffffff),
+    'fps': ('B', 0xff),
+    'resolution': ('H', 0xffff),
+    'hdcp': ('b', -1),
+    'streaming': ('b', -1),
+    'clients': ('B', 0xff),
+}
+MAGIC = b'HS602H\x01'
+
+
+class Series(object):
+    """Fixed-size ring of samples for one device.
+
+    Timestamps and each field live in their own array, so memory is
+    fixed by the size whatever is recorded.
+    """
+    def __init__(self, size):
+        """
+        :param size: Samples kept.
+        """
+        self.size = int(size)
+        self.head = 0
+        self.count = 0
+        self.times = array('d', bytes(8 * self.size))
+        self.fields = dict()
+        for name, (code, missing) in FIELDS.items():
+            self.fields[name] = array(code, [missing]) * self.size
+
+    def append(self, timestamp, values):
+        """Add a sample, overwriting the oldest when full.
+
+        :param timestamp: Sample time.
+        :param values: Dict of field to stored value.
+        """
+        pos = self.head
+        self.times[pos] = timestamp
+        for name, (code, missing) in FIELDS.items():
+            self.fields[name][pos] = values.get(name, missing)
+        self.head = (pos + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def index(self, logical):
+        """Array position of the nth oldest sample.
+
+        :param logical: Logical index.
+        """
+        return (self.head - self.count + logical) % self.size
+
+    def bisect(self, timestamp):
+        """Logical index of the first sample at or after a time.
+
+        :param timestamp: Time to find.
+        """
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.times[self.index(mid)] < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def span(self, start=None, end=None):
+        """Logical index range of samples between two times.
+
+        :param start: (optional) First time, inclusive.
+        :param end: (optional) Last time, exclusive.
+        """
+        first = 0 if start is None else self.bisect(start)
+        last = self.count if end is None else self.bisect(end)
+        return first, max(first, last)
+
+    def ordered(self, data, first=0, last=None):
+        """Slice of an array in oldest to newest order.
+
+        :param data: Times or a field array.
+        :param first: First logical index.
+        :param last: Last logical index (exclusive).
+        """
+        last = self.count if last is None else last
+        if first >= last:
+            return data[0:0]
+        begin = self.index(first)
+        stop = begin + last - first
+        if stop <= self.size:
+            return data[begin:stop]
+        return data[begin:] + data[:stop - self.size]
+
+
+class History(object):
+    """Compact recent history of device state.
+
+    Each device gets a ring buffer sized for the retention at the sample
+    interval, e.g. 24 hours of samples every 5 seconds.
+    """
+    def __init__(self, retention=86400, interval=5):
+        """
+        :param retention: Seconds of history kept - default 86400.
+        :param interval: Expected seconds between samples - default 5.
+        """
+        self.size = max(1, int(retention // interval))
+        self.series = dict()
+        self.strings = list()
+        self.codes = dict()
+        self.lock = threading.Lock()
+
+    def code(self, value):
+        """Intern a string, returns its code.
+
+        :param value: String to intern.
+        """
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.strings)
+            self.strings.append(value)
+        return code
+
+    def encode(self, name, value):
+        """Stored form of a value.
+
+        :param name: Field name.
+        :param value: Value to encode.
+        """
+        if value is None:
+            return FIELDS[name][1]
+        if name == 'resolution':
+            return self.code(str(value))
+        if name == 'clients' and isinstance(value, (tuple, list)):
+            # Client ID and total, only the total is kept.
+            value = value[1]
+        return int(value)
+
+    def decode(self, name, value):
+        """Value from its stored form.
+
+        :param name: Field name.
+        :param value: Stored value.
+        """
+        if value == FIELDS[name][1]:
+            return None
+        if name == 'resolution':
+            return self.strings[value]
+        if name in ('hdcp', 'streaming'):
+            return bool(value)
+        return value
+
+    def record(self, device, timestamp=None, **values):
+        """Record a sample.
+
+        :param device: Device address.
+        :param timestamp: (optional) Sample time - default now.
+        :param values: Field values, e.g. bitrate=8000, streaming=True,
+        unknown fields are ignored.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            series = self.series.get(device)
+            if not series:
+                series = self.series[device] = Series(self.size)
+            stored = {name: self.encode(name, value)
+                      for name, value in values.items() if name in FIELDS}
+            series.append(timestamp, stored)
+
+    def record_settings(self, device, settings, timestamp=None):
+        """Record a sample from Controller.settings().
+
+        :param device: Device address.
+        :param settings: Tuple of dicts (or a dict) from settings().
+        :param timestamp: (optional) Sample time - default now.
+        """
+        if isinstance(settings, dict):
+            settings = (settings,)
+        values = dict()
+        for part in settings:
+            values.update(part)
+        self.record(device, timestamp, **values)
+
+    def query(self, device, field, start=None, end=None):
+        """Samples of a field between two times, a list of time, value
+        pairs, missing samples are skipped.
+
+        :param device: Device address.
+        :param field: Field name.
+        :param start: (optional) First time, inclusive.
+        :param end: (optional) Last time, exclusive.
+        """
+        if field not in FIELDS:
+            raise ValueError(_('unknown field {}, must be one of: '
+                               '{}').format(field, list(FIELDS)))
+        with self.lock:
+            series = self.series.get(device)
+            if not series:
+                return list()
+            first, last = series.span(start, end)
+            times = series.ordered(series.times, first, last)
+            values = series.ordered(series.fields[field], first, last)
+        missing = FIELDS[field][1]
+        return [(stamp, self.decode(field, value))
+                for stamp, value in zip(times, values) if value != missing]
+
+    def downsample(self, device, field, step, start=None, end=None,
+                   how='mean'):
+        """Samples grouped into buckets of step seconds, a list of
+        bucket start, value pairs.
+
+        :param device: Device address.
+        :param field: Field name.
+        :param step: Bucket width in seconds.
+        :param start: (optional) First time, inclusive.
+        :param end: (optional) Last time, exclusive.
+        :param how: mean, min, max or last - default mean, resolution
+        always uses last.
+        """
+        reducers = {
+            'mean': lambda values: sum(values) / len(values),
+            'min': min,
+            'max': max,
+            'last': lambda values: values[-1],
+        }
+        if how not in reducers:
+            raise ValueError(_('unknown reduction {}, must be one of: '
+                               '{}').format(how, list(reducers)))
+        if field == 'resolution':
+            how = 'last'
+        reduce = reducers[how]
+
+        buckets = list()
+        bucket = values = None
+        for stamp, value in self.query(device, field, start, end):
+            key = stamp - stamp % step
+            if key != bucket:
+                if values:
+                    buckets.append((bucket, reduce(values)))
+                bucket, values = key, list()
+            values.append(value)
+        if values:
+            buckets.append((bucket, reduce(values)))
+        return buckets
+
+    def dump(self, path):
+        """Write the history to a compact binary file.
+
+        :param path: File path.
+        """
+        with self.lock, open(path, 'wb') as out:
+            out.write(MAGIC)
+            out.write(struct.pack('<II', self.size, len(self.strings)))
+            for value in self.strings:
+                data = value.encode('utf-8')
+                out.write(struct.pack('<H', len(data)) + data)
+            out.write(struct.pack('<I', len(self.series)))
+            for device, series in self.series.items():
+                name = str(device).encode('utf-8')
+                out.write(struct.pack('<HI', len(name), series.count))
+                out.write(name)
+                # Little endian, oldest first.
+                for data in [series.times] + [series.fields[field]
+                                              for field in FIELDS]:
+                    data = series.ordered(data)
+                    if sys.byteorder == 'big':
+                        data.byteswap()
+                    out.write(data.tobytes())
+
+    @classmethod
+    def load(cls, path):
+        """Read a history written by dump().
+
+        :param path: File path.
+        """
+        with open(path, 'rb') as src:
+            if src.read(len(MAGIC)) != MAGIC:
+                raise ValueError(_('not a history file'))
+            size, strings = struct.unpack('<II', src.read(8))
+            history = cls(retention=size, interval=1)
+            for pos in range(strings):
+                length, = struct.unpack('<H', src.read(2))
+                history.code(src.read(length).decode('utf-8'))
+            devices, = struct.unpack('<I', src.read(4))
+            for pos in range(devices):
+                length, count = struct.unpack('<HI', src.read(6))
+                device = src.read(length).decode('utf-8')
+                series = history.series[device] = Series(size)
+                series.count = count
+                series.head = count % size
+                for data in [series.times] + [series.fields[field]
+                                              for field in FIELDS]:
+                    chunk = array(data.typecode)
+                    chunk.frombytes(src.read(count * data.itemsize))
+                    if sys.byteorder == 'big':
+                        chunk.byteswap()
+                    data[0:count] = chunk
+        return history
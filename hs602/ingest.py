@@ -0,0 +1,183 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import gettext
+import os
+import socket
+import struct
+import sys
+import warnings
+
+gettext.install('hs602_controller')
+
+LINUX = sys.platform.startswith('linux')
+# Not every Python exports these, the values are Linux's.
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33 if LINUX else None)
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40 if LINUX else None)
+
+
+class UndersizedBuffer(RuntimeWarning):
+    """Receive buffer smaller than the stream needs."""
+
+
+def buffer_size(bitrate, stall=0.5, overhead=1.2):
+    """Receive buffer bytes needed to ride out a stall.
+
+    :param bitrate: Stream bitrate in kbps, e.g. Controller.bitrate().
+    :param stall: Seconds the receiver may stall - default 0.5.
+    :param overhead: Allowance for audio, TS/RTP headers and bursts -
+    default 1.2.
+    """
+    return int(int(bitrate) * 1000 / 8 * float(stall) * float(overhead))
+
+
+def tune(sock, bitrate, stall=0.5, overhead=1.2):
+    """Size a socket's receive buffer for a stream, returns the bytes
+    requested and granted, warns if the kernel granted less.
+
+    :param sock: Socket to tune.
+    :param bitrate: Stream bitrate in kbps.
+    :param stall: Seconds the receiver may stall - default 0.5.
+    :param overhead: Allowance for headers and bursts - default 1.2.
+    """
+    wanted = buffer_size(bitrate, stall, overhead)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, wanted)
+    granted = rcvbuf(sock)
+    if granted < wanted and SO_RCVBUFFORCE is not None:
+        # Past net.core.rmem_max, needs CAP_NET_ADMIN.
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, wanted)
+            granted = rcvbuf(sock)
+        except OSError:
+            pass
+    if granted < wanted:
+        warnings.warn(_('receive buffer {} bytes is smaller than the {} '
+                        'bytes a {}kbps stream needs to survive a {}s '
+                        'stall, raise net.core.rmem_max')
+                      .format(granted, wanted, bitrate, stall),
+                      UndersizedBuffer, stacklevel=2)
+    return wanted, granted
+
+
+def rcvbuf(sock):
+    """Usable receive buffer bytes of a socket.
+
+    :param sock: Socket to query.
+    """
+    size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    # Linux reports double, half is kept for bookkeeping.
+    return size // 2 if LINUX else size
+
+
+def count_drops(sock):
+    """Ask the kernel to attach its drop counter to each datagram,
+    returns True if supported.
+
+    :param sock: UDP socket.
+    """
+    if SO_RXQ_OVFL is None:
+        return False
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+        return True
+    except OSError:
+        return False
+
+
+def proc_drops(sock):
+    """Kernel drop count for a UDP socket from /proc/net, or None.
+
+    :param sock: UDP socket.
+    """
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+    except (OSError, ValueError):
+        return None
+    for name in ('/proc/net/udp', '/proc/net/udp6'):
+        try:
+            with open(name) as table:
+                next(table)
+                for line in table:
+                    fields = line.split()
+                    if len(fields) > 12 and fields[9] == inode:
+                        return int(fields[12])
+        except (OSError, StopIteration, ValueError):
+            continue
+    return None
+
+
+class Ingest(object):
+    """Receive datagrams on a tuned socket and account for drops.
+
+    Drops are counted by the kernel when the receive queue overflows,
+    application metrics (gaps, late packets) cover the network, so the
+    two together tell which side lost a packet.
+    """
+    def __init__(self, sock, bitrate=None, stall=0.5):
+        """
+        :param sock: Bound UDP socket.
+        :param bitrate: (optional) Stream bitrate in kbps to size the
+        receive buffer for.
+        :param stall: Seconds the receiver may stall - default 0.5.
+        """
+        self.sock = sock
+        self.wanted = self.granted = None
+        if bitrate:
+            self.wanted, self.granted = tune(sock, bitrate, stall)
+        else:
+            self.granted = rcvbuf(sock)
+        self.ancillary = count_drops(sock) and hasattr(sock,
+                                                       'recvmsg_into')
+        self.cmsg = socket.CMSG_SPACE(4) if self.ancillary else 0
+        # The counter is cumulative from when it was enabled.
+        self.drops = 0
+        self.packets = 0
+        self.bytes = 0
+
+    def recv_into(self, buf):
+        """Receive a datagram, returns its length.
+
+        :param buf: Buffer to receive into.
+        """
+        if not self.ancillary:
+            size = self.sock.recv_into(buf)
+        else:
+            size, ancdata, flags, addr = self.sock.recvmsg_into(
+                [buf], self.cmsg)
+            for level, kind, data in ancdata:
+                if (level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and
+                        len(data) >= 4):
+                    self.drops = struct.unpack('=I', data[:4])[0]
+        self.packets += 1
+        self.bytes += size
+        return size
+
+    def kernel_drops(self):
+        """Datagrams the kernel dropped for want of buffer space."""
+        # The datagram carrying the counter is queued before the drops
+        # it would report, /proc is current when it's available.
+        drops = proc_drops(self.sock)
+        return max(self.drops, drops or 0)
+
+    def stats(self):
+        """Buffer sizing and drop counters."""
+        return {
+            'rcvbuf_wanted': self.wanted,
+            'rcvbuf': self.granted,
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'kernel_drops': self.kernel_drops(),
+        }
@@ -0,0 +1,258 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import gettext
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+gettext.install('hs602_controller')
+
+
+class Session(object):
+    """A controller session kept alive by the scheduler."""
+    def __init__(self, controller, interval):
+        """
+        :param controller: Controller to keep alive.
+        :param interval: Seconds between keepalives.
+        """
+        self.controller = controller
+        self.interval = float(interval)
+        self.due = 0
+        self.last = 0
+        self.sent = 0
+        self.skipped = 0
+        self.missed = 0
+        self.error = None
+        self.cancelled = False
+
+
+class Scheduler(object):
+    """Keep any number of controller sessions alive from one scheduling
+    thread and a small pool of senders.
+
+    Sessions are held on a heap ordered by when they are next due, a
+    keepalive is only sent if nothing else has touched the session
+    within its interval. Keepalives are sent from the pool, each within
+    a deadline, so a dead device can't hold up the others. That costs a
+    few threads rather than one, however many sessions there are, pass
+    workers=0 to send from the scheduling thread alone.
+    """
+    def __init__(self, interval=5, jitter=0.1, grace=None, missed=None,
+                 workers=4, limit=None):
+        """
+        :param interval: Default seconds between keepalives - default 5.
+        :param jitter: Random spread as a fraction of the interval -
+        default 0.1.
+        :param grace: Seconds late a keepalive may be sent before it
+        counts as missed - default the interval.
+        :param missed: (optional) callable, called with the session and
+        exception (or None if late) when a keepalive is missed.
+        :param workers: Keepalives sent at once, 0 sends them from the
+        scheduler thread - default 4.
+        :param limit: (optional) Seconds a keepalive may take - default
+        half the interval or the controller timeout, whichever is less.
+        """
+        self.interval = float(interval)
+        self.jitter = float(jitter)
+        self.grace = self.interval if grace is None else float(grace)
+        self.missed = missed
+        self.workers = int(workers)
+        self.limit = None if limit is None else float(limit)
+        self.pool = None
+        self.sessions = dict()
+        self.heap = list()
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.woken = False
+
+    def spread(self, interval):
+        """Jitter an interval.
+
+        :param interval: Interval to jitter.
+        """
+        jitter = interval * self.jitter
+        return interval + random.uniform(-jitter, jitter)
+
+    def push(self, session, due):
+        """Queue a session.
+
+        :param session: Session to queue.
+        :param due: Time the session is next due.
+        """
+        session.due = due
+        heapq.heappush(self.heap, (due, next(self.seq), session))
+
+    def add(self, controller, interval=None):
+        """Add a controller, returns its session.
+
+        :param controller: Controller to keep alive.
+        :param interval: (optional) Seconds between keepalives.
+        """
+        interval = self.interval if interval is None else interval
+        with self.cond:
+            self.remove(controller)
+            session = Session(controller, interval)
+            self.sessions[id(controller)] = session
+            self.push(session, time.monotonic() + self.spread(interval))
+            self.woken = True
+            self.cond.notify()
+        return session
+
+    def remove(self, controller):
+        """Stop keeping a controller alive.
+
+        :param controller: Controller to remove.
+        """
+        with self.cond:
+            session = self.sessions.pop(id(controller), None)
+            if session:
+                # Removed lazily from the heap.
+                session.cancelled = True
+            return session
+
+    def miss(self, session, exc=None):
+        """Record a missed keepalive.
+
+        :param session: Session that missed.
+        :param exc: Exception raised, if any.
+        """
+        session.missed += 1
+        session.error = exc
+        if self.missed:
+            self.missed(session, exc)
+
+    def beat(self, session, now):
+        """Keep one session alive, returns when it is next due.
+
+        :param session: Session due.
+        :param now: Current time.
+        """
+        controller = session.controller
+        # Recent traffic (other than our own) already keeps the session
+        # alive.
+        if (controller.last > session.last and
+                now - controller.last < session.interval):
+            session.skipped += 1
+            return controller.last + session.interval * (
+                1 + random.uniform(0, self.jitter))
+
+        late = now - session.due > self.grace
+        limit = self.limit
+        if limit is None:
+            limit = min(controller.timeout, session.interval / 2)
+        try:
+            with controller.within(limit):
+                if not controller.keepalive():
+                    raise Exception(_('server rejected keepalive'))
+            session.sent += 1
+            session.last = controller.last
+            session.error = None
+        except Exception as exc:
+            # Late or not, it's one miss.
+            self.miss(session, exc)
+        else:
+            if late:
+                self.miss(session)
+        return time.monotonic() + self.spread(session.interval)
+
+    def keep(self, session):
+        """Keep one session alive and requeue it.
+
+        :param session: Session due.
+        """
+        due = time.monotonic() + self.spread(session.interval)
+        try:
+            due = self.beat(session, time.monotonic())
+        finally:
+            with self.cond:
+                if not session.cancelled:
+                    self.push(session, due)
+                    self.woken = True
+                    self.cond.notify()
+
+    def run_pending(self):
+        """Send keepalives that are due, returns seconds until the next
+        one (or None if there are no sessions)."""
+        while True:
+            with self.cond:
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    return None
+                now = time.monotonic()
+                due, _seq, session = self.heap[0]
+                if due > now:
+                    return due - now
+                heapq.heappop(self.heap)
+                pool = self.pool
+
+            # Out of the heap until sent, so it's only sent once.
+            if pool:
+                pool.submit(self.keep, session)
+            else:
+                self.keep(session)
+
+    def run(self):
+        """Scheduler loop."""
+        while self.running:
+            wait = self.run_pending()
+            with self.cond:
+                # Don't sleep through a session added meanwhile.
+                if self.running and not self.woken:
+                    self.cond.wait(wait)
+                self.woken = False
+
+    def start(self):
+        """Start the scheduler thread."""
+        with self.cond:
+            if self.thread:
+                return
+            self.running = True
+            if self.workers:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+            self.thread = threading.Thread(target=self.run,
+                                           name='hs602-keepalive',
+                                           daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the scheduler thread."""
+        with self.cond:
+            self.running = False
+            thread, self.thread = self.thread, None
+            self.cond.notify()
+        if thread and thread is not threading.current_thread():
+            thread.join()
+        pool, self.pool = self.pool, None
+        if pool:
+            pool.shutdown(wait=True)
+
+    def stats(self):
+        """Sent, skipped and missed keepalive totals."""
+        with self.cond:
+            sessions = list(self.sessions.values())
+        return {
+            'sessions': len(sessions),
+            'sent': sum(s.sent for s in sessions),
+            'skipped': sum(s.skipped for s in sessions),
+            'missed': sum(s.missed for s in sessions),
+        }
@@ -0,0 +1,179 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+CONTROL = 0
+TELEMETRY = 1
+BULK = 2
+
+# Command id and its priority class, anything else is telemetry.
+COMMANDS = {
+    # Keepalive, source, mode, base port, streaming and LED.
+    0: CONTROL,
+    1: CONTROL,
+    8: CONTROL,
+    14: CONTROL,
+    15: CONTROL,
+    55: CONTROL,
+    # Bitrate, picture, resolution, HDCP, colour, fps, clients, firmware.
+    2: TELEMETRY,
+    3: TELEMETRY,
+    4: TELEMETRY,
+    5: TELEMETRY,
+    10: TELEMETRY,
+    19: TELEMETRY,
+    50: TELEMETRY,
+    56: TELEMETRY,
+    # RTMP strings, sent a character per frame.
+    16: BULK,
+    17: BULK,
+    20: BULK,
+    21: BULK,
+    23: BULK,
+}
+
+
+def classify(msg):
+    """Priority class of a command.
+
+    :param msg: Command message.
+    """
+    return COMMANDS.get(msg[0], TELEMETRY) if msg else TELEMETRY
+
+
+class PriorityLock(object):
+    """Lock handed to the most urgent waiter first.
+
+    Waiters queue by priority class then arrival. Holding it for a single
+    frame lets a long transfer be overtaken at each frame boundary, and a
+    waiter is served in arrival order once it has waited longer than
+    starve so a busy session can't shut out bulk transfers for good. It
+    is reentrant.
+    """
+    def __init__(self, starve=2):
+        """
+        :param starve: Seconds a waiter waits before it is served ahead of
+        more urgent ones - default 2.
+        """
+        self.starve = float(starve)
+        self.cond = threading.Condition(threading.Lock())
+        self.owner = None
+        self.depth = 0
+        self.waiters = list()
+        self.order = itertools.count()
+        self.waits = [0, 0, 0]
+        self.waited = [0.0, 0.0, 0.0]
+
+    def first(self, now):
+        """Waiter to serve next.
+
+        :param now: Current (monotonic) time.
+        """
+        return min(self.waiters,
+                   key=lambda waiter: (waiter[0] if now - waiter[2] <
+                                       self.starve else -1, waiter[1]))
+
+    def acquire(self, priority=TELEMETRY, timeout=None, cancelled=None):
+        """Wait for the lock, returns False if it timed out or was
+        cancelled.
+
+        :param priority: CONTROL, TELEMETRY or BULK.
+        :param timeout: (optional) Seconds to wait.
+        :param cancelled: (optional) Callable, stop waiting once it
+        returns True, see wake().
+        """
+        me = threading.get_ident()
+        with self.cond:
+            if self.owner == me:
+                self.depth += 1
+                return True
+            since = time.monotonic()
+            end = None if timeout is None else since + timeout
+            waiter = (int(priority), next(self.order), since)
+            self.waiters.append(waiter)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if (self.owner is None and
+                            self.first(now) is waiter):
+                        self.owner = me
+                        break
+                    if cancelled is not None and cancelled():
+                        return False
+                    # Wake to promote starved waiters.
+                    wait = self.starve
+                    if end is not None:
+                        if now >= end:
+                            return False
+                        wait = min(wait, end - now)
+                    self.cond.wait(wait)
+            finally:
+                self.waiters.remove(waiter)
+                if self.owner is None:
+                    # Let the next waiter in if we gave up.
+                    self.cond.notify_all()
+            self.depth = 1
+            self.waits[waiter[0]] += 1
+            self.waited[waiter[0]] += time.monotonic() - since
+            return True
+
+    def wake(self):
+        """Wake waiters to check whether they're cancelled."""
+        with self.cond:
+            self.cond.notify_all()
+
+    def release(self):
+        """Release the lock, the next waiter is chosen by priority."""
+        with self.cond:
+            if self.owner != threading.get_ident():
+                raise RuntimeError('cannot release un-acquired lock')
+            self.depth -= 1
+            if not self.depth:
+                self.owner = None
+                self.cond.notify_all()
+
+    @contextmanager
+    def hold(self, priority=TELEMETRY):
+        """Hold the lock for a block.
+
+        :param priority: CONTROL, TELEMETRY or BULK.
+        """
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def stats(self):
+        """Acquisitions and mean wait in seconds by priority class."""
+        with self.cond:
+            return {name: {'acquired': self.waits[cls],
+                           'wait': (self.waited[cls] / self.waits[cls]
+                                    if self.waits[cls] else 0.0)}
+                    for name, cls in (('control', CONTROL),
+                                      ('telemetry', TELEMETRY),
+                                      ('bulk', BULK))}
@@ -0,0 +1,293 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import socket
+import threading
+import time
+from array import array
+from hs602.controller import Controller
+from hs602.ingest import Ingest
+
+
+class Reorder(object):
+    """Put RTP packets back in sequence order.
+
+    Packets wait in a ring of preallocated slots indexed from the next
+    expected sequence number, so any number of slots stays contiguous
+    across the sequence wrap. In-order packets are passed on at once, a gap is waited on
+    for up to the delay before it is counted as lost and skipped. Buffers
+    are swapped rather than copied, push() takes a filled buffer and
+    hands back an empty one to receive into.
+
+    A restarted stream starts from a new random sequence number (and
+    usually SSRC), so a new SSRC, a jump far outside the window or a run
+    of late packets starts over at the new sequence without counting
+    loss.
+    """
+    def __init__(self, output, slots=512, size=2048, delay=0.05, jump=None,
+                 resync=16):
+        """
+        :param output: Callable taking a buffer and its length for each
+        packet in order, the buffer is reused once it returns.
+        :param slots: Packets the window holds - default 512.
+        :param size: Largest packet - default 2048.
+        :param delay: Seconds to wait for a missing packet - default
+        0.05.
+        :param jump: Sequence jump treated as a restart - default four
+        times the slots.
+        :param resync: Late packets in a row treated as a restart -
+        default 16.
+        """
+        self.output = output
+        self.slots = int(slots)
+        self.size = int(size)
+        self.delay = float(delay)
+        self.jump = self.slots * 4 if jump is None else int(jump)
+        self.resync_after = int(resync)
+        self.ssrc = None
+        self.late_run = 0
+        self.buffers = [bytearray(self.size) for slot in range(self.slots)]
+        self.lengths = array('H', [0]) * self.slots
+        self.present = bytearray(self.slots)
+        self.spare = bytearray(self.size)
+        self.next = None
+        # Slot of the next sequence number.
+        self.head = 0
+        self.buffered = 0
+        self.gap_since = None
+        self.received = 0
+        self.delivered = 0
+        self.lost = 0
+        self.gaps = 0
+        self.late = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.invalid = 0
+        self.resyncs = 0
+
+    def deliver(self):
+        """Pass on packets that are next in sequence."""
+        while self.buffered:
+            slot = self.head
+            if not self.present[slot]:
+                break
+            self.output(self.buffers[slot], self.lengths[slot])
+            self.present[slot] = 0
+            self.buffered -= 1
+            self.delivered += 1
+            self.advance()
+
+    def advance(self):
+        """Move on to the next sequence number."""
+        self.next = (self.next + 1) & 0xffff
+        self.head = (self.head + 1) % self.slots
+
+    def skip(self):
+        """Give up on the missing packets before the next buffered one."""
+        skipped = 0
+        while self.buffered and not self.present[self.head]:
+            self.advance()
+            skipped += 1
+        if skipped:
+            self.lost += skipped
+            self.gaps += 1
+        self.deliver()
+
+    def push(self, buf, length, now=None):
+        """Add a received packet, returns a free buffer.
+
+        :param buf: Buffer holding the packet.
+        :param length: Packet length.
+        :param now: (optional) Receive time.
+        """
+        self.received += 1
+        # RTP version 2 header.
+        if length < 12 or buf[0] >> 6 != 2:
+            self.invalid += 1
+            return buf
+        seq = buf[2] << 8 | buf[3]
+        ssrc = buf[8] << 24 | buf[9] << 16 | buf[10] << 8 | buf[11]
+        if self.next is None:
+            self.next = seq
+        elif ssrc != self.ssrc:
+            self.resync(seq)
+        self.ssrc = ssrc
+
+        ahead = (seq - self.next) & 0xffff
+        if ahead >= 0x8000:
+            # Behind the window, already delivered or given up on,
+            # unless it's too far behind or keeps happening.
+            self.late_run += 1
+            if (0x10000 - ahead <= self.jump and
+                    self.late_run < self.resync_after):
+                self.late += 1
+                return buf
+            self.resync(seq)
+            ahead = 0
+        elif ahead >= self.jump:
+            self.resync(seq)
+            ahead = 0
+        self.late_run = 0
+        while ahead >= self.slots:
+            # Past the window, make room by giving up on the oldest.
+            if self.buffered:
+                self.skip()
+            else:
+                self.lost += ahead - self.slots + 1
+                self.gaps += 1
+                self.next = (seq - self.slots + 1) & 0xffff
+            ahead = (seq - self.next) & 0xffff
+
+        slot = (self.head + ahead) % self.slots
+        if self.present[slot]:
+            self.duplicates += 1
+            return buf
+        if ahead:
+            self.reordered += 1
+        free = self.buffers[slot]
+        self.buffers[slot] = buf
+        self.lengths[slot] = length
+        self.present[slot] = 1
+        self.buffered += 1
+        self.deliver()
+
+        if not self.buffered:
+            self.gap_since = None
+        elif self.gap_since is None:
+            self.gap_since = time.monotonic() if now is None else now
+        return free
+
+    def expire(self, now=None):
+        """Skip a gap that has been waited on for longer than the delay.
+
+        :param now: (optional) Current time.
+        """
+        if self.gap_since is None:
+            return
+        now = time.monotonic() if now is None else now
+        if now - self.gap_since < self.delay:
+            return
+        self.skip()
+        self.gap_since = now if self.buffered else None
+
+    def flush(self):
+        """Pass on everything buffered, skipping gaps."""
+        while self.buffered:
+            self.skip()
+        self.gap_since = None
+
+    def resync(self, seq):
+        """Start over at a new sequence number, what's buffered is passed
+        on and nothing is counted lost.
+
+        :param seq: New sequence number.
+        """
+        lost, gaps = self.lost, self.gaps
+        self.flush()
+        self.lost, self.gaps = lost, gaps
+        self.next = seq
+        self.late_run = 0
+        self.resyncs += 1
+
+    def stats(self):
+        """Packet counters."""
+        expected = self.delivered + self.lost
+        return {
+            'received': self.received,
+            'delivered': self.delivered,
+            'lost': self.lost,
+            'gaps': self.gaps,
+            'late': self.late,
+            'duplicates': self.duplicates,
+            'reordered': self.reordered,
+            'invalid': self.invalid,
+            'resyncs': self.resyncs,
+            'buffered': self.buffered,
+            'loss': self.lost / expected if expected else 0.0,
+        }
+
+
+class Receiver(object):
+    """Receive a unicast or broadcast mode stream through a reorder
+    buffer."""
+    def __init__(self, output, port=8085, host='', bitrate=None,
+                 stall=0.5, **options):
+        """
+        :param output: Callable taking a buffer and length, see Reorder.
+        :param port: Stream receive port - default 8085.
+        :param host: Address to bind - default all.
+        :param bitrate: (optional) Device bitrate in kbps, sizes the
+        receive buffer.
+        :param stall: Seconds the receiver may stall - default 0.5.
+        :param options: Reorder keyword args, e.g. delay, slots.
+        """
+        self.reorder = Reorder(output, **options)
+        self.port = Controller.port(port)
+        self.host = str(host)
+        self.bitrate = bitrate
+        self.stall = stall
+        self.sock = None
+        self.ingest = None
+        self.thread = None
+
+    def run(self):
+        """Receive loop."""
+        sock = self.sock
+        ingest = self.ingest
+        reorder = self.reorder
+        buf = reorder.spare
+        while self.sock is sock:
+            try:
+                length = ingest.recv_into(buf)
+            except socket.timeout:
+                reorder.expire()
+                continue
+            except OSError:
+                break
+            now = time.monotonic()
+            buf = reorder.push(buf, length, now)
+            reorder.expire(now)
+        reorder.flush()
+
+    def start(self):
+        """Bind and receive in a background thread."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        # Wake often enough to time out gaps when the stream stalls.
+        sock.settimeout(max(self.reorder.delay / 2, 0.001))
+        self.ingest = Ingest(sock, self.bitrate, self.stall)
+        self.sock = sock
+        self.thread = threading.Thread(target=self.run,
+                                       name='hs602-rtp', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop receiving."""
+        sock, self.sock = self.sock, None
+        # Unconnected UDP, shutdown() would fail before closing it.
+        if sock:
+            sock.close()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        """Reorder counters alongside socket buffer and kernel drops."""
+        stats = self.reorder.stats()
+        if self.ingest:
+            stats.update(self.ingest.stats())
+        return stats
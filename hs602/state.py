@@ -0,0 +1,237 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import gettext
+import json
+import struct
+
+gettext.install('hs602_controller')
+
+MODES = ['unicast', 'broadcast', 'tcp']
+SOURCES = ['analogue', 'hdmi']
+MAGIC = b'HS6S'
+VERSION = 1
+# Magic, version, presence mask, then the fixed-size fields.
+HEADER = struct.Struct('<4sBI')
+NUMBERS = struct.Struct('<BBBBBBIHHBBBBBB')
+# Strings follow as utf-8 with a 2-byte length, RTMP values are up to
+# 255 characters of chr(0-255).
+LENGTH = struct.Struct('<H')
+STRINGS = ['firmware', 'resolution', 'username', 'password', 'key', 'url',
+           'name']
+
+
+def flag(value):
+    """Boolean field.
+
+    :param value: Value to convert.
+    """
+    return bool(value)
+
+
+def picture(value):
+    """Picture size as a width, height tuple.
+
+    :param value: "width,height" or a pair.
+    """
+    if isinstance(value, str):
+        value = value.replace(' ', '').split(',')
+    width, height = value
+    return int(width), int(height)
+
+
+def choice(choices):
+    """Coercer for a value from a fixed list.
+
+    :param choices: Allowed values.
+    """
+    def coerce(value):
+        value = str(value).lower()
+        if value not in choices:
+            raise ValueError(_('invalid value {}, must be one of: '
+                               '{}').format(value, choices))
+        return value
+    return coerce
+
+
+def clients(value):
+    """Client ID and total connected clients.
+
+    :param value: Pair of ints.
+    """
+    client, total = value
+    return int(client), int(total)
+
+
+class DeviceState(object):
+    """Typed snapshot of a device's settings.
+
+    Fields left unknown are None. Snapshots compare equal field by
+    field, diff() lists what changed, and they round trip through a
+    compact binary encoding or JSON.
+    """
+    fields = (
+        ('firmware', str),
+        ('resolution', str),
+        ('clients', clients),
+        ('hdcp', flag),
+        ('mode', choice(MODES)),
+        ('fps', int),
+        ('streaming', flag),
+        ('bitrate', int),
+        ('picture', picture),
+        ('saturation', int),
+        ('hue', int),
+        ('contrast', int),
+        ('brightness', int),
+        ('username', str),
+        ('password', str),
+        ('key', str),
+        ('url', str),
+        ('name', str),
+        ('source', choice(SOURCES)),
+    )
+    __slots__ = tuple(name for name, coerce in fields)
+
+    def __init__(self, **values):
+        """
+        :param values: Field values, unknown names are ignored.
+        """
+        for name, coerce in self.fields:
+            value = values.get(name)
+            setattr(self, name, None if value is None else coerce(value))
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Snapshot from Controller.settings().
+
+        :param settings: Tuple of dicts (or a dict) from settings().
+        """
+        if isinstance(settings, dict):
+            settings = (settings,)
+        values = dict()
+        for part in settings:
+            values.update(part)
+        return cls(**values)
+
+    def as_dict(self):
+        """Fields as a dict."""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other):
+        if not isinstance(other, DeviceState):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name)
+                   for name in self.__slots__)
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'DeviceState({})'.format(', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self.__slots__
+            if getattr(self, name) is not None))
+
+    def diff(self, other):
+        """Fields that differ, a dict of name to this and the other
+        value.
+
+        :param other: DeviceState to compare with.
+        """
+        return {name: (getattr(self, name), getattr(other, name))
+                for name in self.__slots__
+                if getattr(self, name) != getattr(other, name)}
+
+    def to_bytes(self):
+        """Compact binary encoding."""
+        mask = 0
+        for pos, name in enumerate(self.__slots__):
+            if getattr(self, name) is not None:
+                mask |= 1 << pos
+
+        def get(name, default=0):
+            value = getattr(self, name)
+            return default if value is None else value
+
+        client, total = get('clients', (0, 0))
+        width, height = get('picture', (0, 0))
+        mode = MODES.index(self.mode) if self.mode else 0
+        source = SOURCES.index(self.source) if self.source else 0
+        data = [HEADER.pack(MAGIC, VERSION, mask), NUMBERS.pack(
+            client, total, int(get('hdcp')), mode, get('fps'),
+            int(get('streaming')), get('bitrate'), width, height,
+            get('saturation'), get('hue'), get('contrast'),
+            get('brightness'), source, 0)]
+        for name in STRINGS:
+            value = get(name, '').encode('utf-8')
+            if len(value) > 0xffff:
+                raise ValueError(_('{} is too long to encode').format(name))
+            data.append(LENGTH.pack(len(value)) + value)
+        return b''.join(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Decode to_bytes() output.
+
+        :param data: Encoded snapshot.
+        """
+        data = bytes(data)
+        magic, version, mask = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(_('not a device state'))
+        (client, total, hdcp, mode, fps, streaming, bitrate, width, height,
+         saturation, hue, contrast, brightness, source,
+         reserved) = NUMBERS.unpack_from(data, HEADER.size)
+        values = {
+            'clients': (client, total),
+            'hdcp': hdcp,
+            'mode': MODES[mode],
+            'fps': fps,
+            'streaming': streaming,
+            'bitrate': bitrate,
+            'picture': (width, height),
+            'saturation': saturation,
+            'hue': hue,
+            'contrast': contrast,
+            'brightness': brightness,
+            'source': SOURCES[source],
+        }
+        pos = HEADER.size + NUMBERS.size
+        for name in STRINGS:
+            length, = LENGTH.unpack_from(data, pos)
+            pos += LENGTH.size
+            values[name] = data[pos:pos + length].decode('utf-8')
+            pos += length
+        for bit, name in enumerate(cls.__slots__):
+            if not mask & 1 << bit:
+                values[name] = None
+        return cls(**values)
+
+    def to_json(self):
+        """JSON encoding."""
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    @classmethod
+    def from_json(cls, data):
+        """Decode to_json() output.
+
+        :param data: JSON text.
+        """
+        return cls(**json.loads(data))
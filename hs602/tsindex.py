@@ -0,0 +1,285 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import bisect
+import gettext
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+gettext.install('hs602_controller')
+
+PACKET = 188
+SYNC = 0x47
+MAGIC = b'HS602I\x01'
+# Packets scanned per slice.
+STRIDE = 65536
+# PCR base wraps every 2^33 ticks of 90kHz.
+WRAP = (1 << 33) / 90000.0
+
+
+def table(test):
+    """Translate table mapping bytes to 1 where test holds, else 0.
+
+    :param test: Callable taking a byte value.
+    """
+    return bytes(1 if test(value) else 0 for value in range(256))
+
+
+# Adaptation field present, non-empty, and the PCR or random access
+# indicator flags.
+HAS_ADAPTATION = table(lambda value: value & 0x20)
+NON_EMPTY = table(lambda value: value)
+INTERESTING = table(lambda value: value & 0x50)
+
+
+class Index(object):
+    """Random-access index of a TS capture.
+
+    The capture is memory-mapped and scanned a slice of packets at a
+    time: the header bytes of every packet are pulled out with strided
+    slices and tested together, only packets carrying a PCR or a random
+    access indicator are looked at one by one. The index is saved next
+    to the capture and extended as the file grows.
+    """
+    def __init__(self, path, sidecar=None):
+        """
+        :param path: TS capture.
+        :param sidecar: (optional) Index file - default path + '.idx'.
+        """
+        self.path = str(path)
+        self.sidecar = sidecar or self.path + '.idx'
+        self.scanned = 0
+        self.pcr_pid = None
+        self.wraps = 0
+        self.pcr_offsets = array('Q')
+        self.pcr_times = array('d')
+        self.key_offsets = array('Q')
+
+    @classmethod
+    def open(cls, path, sidecar=None):
+        """Load the sidecar if there is one and bring it up to date.
+
+        :param path: TS capture.
+        :param sidecar: (optional) Index file.
+        """
+        index = cls(path, sidecar)
+        if os.path.exists(index.sidecar):
+            try:
+                index.load()
+            except (ValueError, struct.error):
+                index = cls(path, sidecar)
+        index.update()
+        return index
+
+    def pcr(self, data, pos):
+        """PCR seconds of the packet at pos.
+
+        :param data: Mapped capture.
+        :param pos: Packet offset.
+        """
+        base = (data[pos + 6] << 25 | data[pos + 7] << 17 |
+                data[pos + 8] << 9 | data[pos + 9] << 1 |
+                data[pos + 10] >> 7)
+        ext = (data[pos + 10] & 1) << 8 | data[pos + 11]
+        return base / 90000.0 + ext / 27000000.0
+
+    def sync(self, data, pos, end):
+        """Offset of the next run of aligned sync bytes.
+
+        :param data: Mapped capture.
+        :param pos: Offset to search from.
+        :param end: Offset to search to.
+        """
+        while pos + PACKET * 3 <= end:
+            pos = data.find(bytes([SYNC]), pos, end)
+            if pos < 0:
+                break
+            if (data[pos + PACKET] == SYNC and
+                    data[pos + PACKET * 2] == SYNC):
+                return pos
+            pos += 1
+        return None
+
+    def mark(self, data, pos):
+        """Index a packet with an adaptation field of interest.
+
+        :param data: Mapped capture.
+        :param pos: Packet offset.
+        """
+        flags = data[pos + 5]
+        pid = (data[pos + 1] & 0x1f) << 8 | data[pos + 2]
+        if flags & 0x10 and data[pos + 4] >= 7:
+            if self.pcr_pid is None:
+                self.pcr_pid = pid
+            if pid == self.pcr_pid:
+                pcr = self.pcr(data, pos) + self.wraps * WRAP
+                if self.pcr_times and pcr < self.pcr_times[-1] - WRAP / 2:
+                    self.wraps += 1
+                    pcr += WRAP
+                self.pcr_offsets.append(pos)
+                self.pcr_times.append(pcr)
+        if flags & 0x40:
+            self.key_offsets.append(pos)
+
+    def scan(self, data, pos, end):
+        """Scan aligned packets, returns the offset reached.
+
+        :param data: Mapped capture.
+        :param pos: First packet offset.
+        :param end: End of the data.
+        """
+        while pos + PACKET <= end:
+            count = min(STRIDE, (end - pos) // PACKET)
+            stop = pos + count * PACKET
+            syncs = data[pos:stop:PACKET]
+            if syncs.count(bytes([SYNC])) != count:
+                # Lost sync, scan up to the break and find it again.
+                broken = pos + next(i for i, value in enumerate(syncs)
+                                    if value != SYNC) * PACKET
+                if broken > pos:
+                    pos = self.scan(data, pos, broken)
+                found = self.sync(data, broken + 1, end)
+                if found is None:
+                    return broken
+                pos = found
+                continue
+
+            hits = (int.from_bytes(data[pos + 3:stop:PACKET].translate(
+                        HAS_ADAPTATION), 'big') &
+                    int.from_bytes(data[pos + 4:stop:PACKET].translate(
+                        NON_EMPTY), 'big') &
+                    int.from_bytes(data[pos + 5:stop:PACKET].translate(
+                        INTERESTING), 'big'))
+            if hits:
+                hits = hits.to_bytes(count, 'big')
+                found = hits.find(1)
+                while found >= 0:
+                    self.mark(data, pos + found * PACKET)
+                    found = hits.find(1, found + 1)
+            pos = stop
+        return pos
+
+    def update(self):
+        """Index whatever has been written since the last update,
+        returns the number of bytes scanned."""
+        size = os.path.getsize(self.path)
+        if size < self.scanned + PACKET:
+            return 0
+        with open(self.path, 'rb') as src:
+            data = mmap.mmap(src.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                start = self.scanned
+                if not start or data[start] != SYNC:
+                    start = self.sync(data, start, size)
+                    if start is None:
+                        return 0
+                self.scanned = self.scan(data, start, size)
+            finally:
+                data.close()
+        self.save()
+        return self.scanned - start
+
+    def save(self):
+        """Write the sidecar."""
+        tmp = self.sidecar + '.tmp'
+        with open(tmp, 'wb') as out:
+            out.write(MAGIC)
+            out.write(struct.pack('<QiIIII', self.scanned,
+                                  -1 if self.pcr_pid is None
+                                  else self.pcr_pid, self.wraps,
+                                  len(self.pcr_offsets),
+                                  len(self.pcr_times),
+                                  len(self.key_offsets)))
+            for data in (self.pcr_offsets, self.pcr_times,
+                         self.key_offsets):
+                if sys.byteorder == 'big':
+                    data = array(data.typecode, data)
+                    data.byteswap()
+                out.write(data.tobytes())
+        os.replace(tmp, self.sidecar)
+
+    def load(self):
+        """Read the sidecar."""
+        with open(self.sidecar, 'rb') as src:
+            if src.read(len(MAGIC)) != MAGIC:
+                raise ValueError(_('not a ts index file'))
+            header = struct.Struct('<QiIIII')
+            (self.scanned, pcr_pid, self.wraps, offsets, times,
+             keys) = header.unpack(src.read(header.size))
+            self.pcr_pid = None if pcr_pid < 0 else pcr_pid
+            for data, count in ((self.pcr_offsets, offsets),
+                                (self.pcr_times, times),
+                                (self.key_offsets, keys)):
+                del data[:]
+                data.frombytes(src.read(count * data.itemsize))
+                if sys.byteorder == 'big':
+                    data.byteswap()
+        if len(self.pcr_offsets) != len(self.pcr_times):
+            raise ValueError(_('corrupt ts index file'))
+
+    def duration(self):
+        """Seconds between the first and last PCR."""
+        if not self.pcr_times:
+            return 0.0
+        return self.pcr_times[-1] - self.pcr_times[0]
+
+    def offset(self, seconds):
+        """Offset of the first PCR at or after a time.
+
+        :param seconds: Seconds from the start of the capture.
+        """
+        if not self.pcr_times:
+            raise ValueError(_('no timestamps indexed'))
+        pos = bisect.bisect_left(self.pcr_times,
+                                 self.pcr_times[0] + seconds)
+        if pos >= len(self.pcr_offsets):
+            return self.scanned
+        return self.pcr_offsets[pos]
+
+    def keyframe(self, offset):
+        """Offset of the last random access point at or before an
+        offset, or the offset itself if there's none.
+
+        :param offset: Byte offset.
+        """
+        pos = bisect.bisect_right(self.key_offsets, offset)
+        return self.key_offsets[pos - 1] if pos else offset
+
+    def extract(self, start, end, path):
+        """Copy a time range to a new file, starting at a random access
+        point, returns the number of bytes written.
+
+        :param start: Seconds from the start of the capture.
+        :param end: Seconds from the start of the capture.
+        :param path: Output file.
+        """
+        first = self.keyframe(self.offset(start))
+        last = self.offset(end)
+        if last <= first:
+            raise ValueError(_('empty range {} - {}').format(start, end))
+        written = 0
+        with open(self.path, 'rb') as src, open(path, 'wb') as out:
+            src.seek(first)
+            while written < last - first:
+                chunk = src.read(min(1 << 20, last - first - written))
+                if not chunk:
+                    break
+                out.write(chunk)
+                written += len(chunk)
+        return written
@@ -0,0 +1,321 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import gettext
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+gettext.install('hs602_controller')
+
+
+class Backoff(object):
+    """Jittered exponential backoff."""
+    def __init__(self, base=2, cap=120, factor=2):
+        """
+        :param base: First delay in seconds - default 2.
+        :param cap: Longest delay in seconds - default 120.
+        :param factor: Growth per attempt - default 2.
+        """
+        self.base = float(base)
+        self.cap = float(cap)
+        self.factor = float(factor)
+        self.attempts = 0
+
+    def next(self):
+        """Delay before the next attempt."""
+        delay = min(self.cap, self.base * self.factor ** self.attempts)
+        self.attempts += 1
+        # Spread retries so a fleet doesn't restart in lockstep.
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        """Reset after a success."""
+        self.attempts = 0
+
+
+class Watch(object):
+    """Watched device state."""
+    def __init__(self, controller, stream=True, backoff=None):
+        """
+        :param controller: Controller to watch.
+        :param stream: Should the device be streaming - default True.
+        :param backoff: (optional) Backoff to use for restarts.
+        """
+        self.controller = controller
+        self.stream = bool(stream)
+        self.backoff = backoff or Backoff()
+        self.streaming = None
+        self.resolution = None
+        self.hdcp = None
+        # Why the device is down (session, input or stream) and since
+        # when, or None if it's healthy.
+        self.down = None
+        self.down_since = None
+        self.retry = 0
+        self.restarts = 0
+        self.recoveries = list()
+        self.error = None
+        self.cancelled = False
+
+
+class Watchdog(object):
+    """Watch many devices and recover their streams.
+
+    Each device is polled for its streaming, resolution and HDCP state.
+    Dead sessions are dropped so the next poll knocks and reconnects,
+    and a stream that stops while it should be running is toggled back
+    on, attempts are spaced by a jittered backoff.
+    """
+    def __init__(self, interval=5, workers=8, changed=None,
+                 recovered=None):
+        """
+        :param interval: Seconds between polls of a device - default 5.
+        :param workers: Devices polled at once - default 8.
+        :param changed: (optional) callable, called with the watch, the
+        signal name, old and new values when a signal changes.
+        :param recovered: (optional) callable, called with the watch and
+        the seconds it took to recover.
+        """
+        self.interval = float(interval)
+        self.workers = int(workers)
+        self.changed = changed
+        self.recovered = recovered
+        self.watches = dict()
+        self.heap = list()
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.pool = None
+        self.thread = None
+        self.running = False
+        self.woken = False
+
+    def push(self, watch, due):
+        """Queue a watch.
+
+        :param watch: Watch to queue.
+        :param due: Time the watch is next due.
+        """
+        heapq.heappush(self.heap, (due, next(self.seq), watch))
+
+    def add(self, controller, stream=True, backoff=None):
+        """Watch a controller, returns its watch.
+
+        :param controller: Controller to watch.
+        :param stream: Should the device be streaming - default True.
+        :param backoff: (optional) Backoff to use for restarts.
+        """
+        with self.cond:
+            self.remove(controller)
+            watch = Watch(controller, stream=stream, backoff=backoff)
+            self.watches[id(controller)] = watch
+            self.push(watch, time.monotonic())
+            self.woken = True
+            self.cond.notify()
+        return watch
+
+    def remove(self, controller):
+        """Stop watching a controller.
+
+        :param controller: Controller to remove.
+        """
+        with self.cond:
+            watch = self.watches.pop(id(controller), None)
+            if watch:
+                watch.cancelled = True
+            return watch
+
+    def signal(self, watch, name, value):
+        """Update a watched signal.
+
+        :param watch: Watch to update.
+        :param name: Signal name.
+        :param value: New value.
+        """
+        old = getattr(watch, name)
+        setattr(watch, name, value)
+        if old != value and self.changed:
+            self.changed(watch, name, old, value)
+
+    def fail(self, watch, reason, now):
+        """Mark a device as down.
+
+        :param watch: Watch that failed.
+        :param reason: Why - session, input or stream.
+        :param now: Current time.
+        """
+        if watch.down is None:
+            watch.down_since = now
+        watch.down = reason
+
+    def recover(self, watch, now):
+        """Mark a device as healthy.
+
+        :param watch: Watch that recovered.
+        :param now: Current time.
+        """
+        if watch.down is None:
+            return
+        elapsed = now - watch.down_since
+        watch.recoveries.append(elapsed)
+        watch.down = watch.down_since = None
+        watch.error = None
+        watch.backoff.reset()
+        watch.retry = 0
+        if self.recovered:
+            self.recovered(watch, elapsed)
+
+    def check(self, watch):
+        """Poll one device and recover it if needed.
+
+        :param watch: Watch to check.
+        """
+        controller = watch.controller
+        now = time.monotonic()
+        try:
+            streaming = controller.streaming()
+        except Exception as exc:
+            # Dead session, the next poll will knock again.
+            controller.disconnect()
+            watch.error = exc
+            self.signal(watch, 'streaming', None)
+            self.fail(watch, 'session', now)
+            return
+        self.signal(watch, 'streaming', streaming)
+
+        try:
+            resolution = controller.resolution()
+            hdcp = controller.hdcp()
+        except OSError as exc:
+            controller.disconnect()
+            watch.error = exc
+            self.fail(watch, 'session', now)
+            return
+        except Exception as exc:
+            # Unknown resolution, no usable input.
+            resolution = hdcp = None
+            watch.error = exc
+        if resolution and resolution.startswith('0x0'):
+            resolution = None
+        self.signal(watch, 'resolution', resolution)
+        self.signal(watch, 'hdcp', hdcp)
+
+        if not watch.stream or streaming:
+            self.recover(watch, now)
+            return
+        if resolution is None:
+            # Nothing to stream until the input returns.
+            self.fail(watch, 'input', now)
+            return
+
+        self.fail(watch, 'stream', now)
+        if now < watch.retry:
+            return
+        watch.retry = now + watch.backoff.next()
+        watch.restarts += 1
+        try:
+            if controller.streaming(toggle=True):
+                self.recover(watch, time.monotonic())
+        except Exception as exc:
+            controller.disconnect()
+            watch.error = exc
+
+    def done(self, watch):
+        """Requeue a watch after its check.
+
+        :param watch: Watch checked.
+        """
+        due = time.monotonic() + self.interval
+        if watch.down and watch.retry:
+            due = min(due, max(watch.retry, time.monotonic()))
+        with self.cond:
+            if not watch.cancelled:
+                self.push(watch, due)
+                self.woken = True
+                self.cond.notify()
+
+    def poll(self, watch):
+        """Check a watch and requeue it.
+
+        :param watch: Watch to poll.
+        """
+        try:
+            self.check(watch)
+        finally:
+            self.done(watch)
+
+    def run(self):
+        """Watchdog loop."""
+        while True:
+            with self.cond:
+                while self.running:
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                    wait = None
+                    if self.heap:
+                        wait = self.heap[0][0] - time.monotonic()
+                        if wait <= 0:
+                            break
+                    if not self.woken:
+                        self.cond.wait(wait)
+                    self.woken = False
+                if not self.running:
+                    return
+                watch = heapq.heappop(self.heap)[2]
+            self.pool.submit(self.poll, watch)
+
+    def start(self):
+        """Start watching."""
+        with self.cond:
+            if self.thread:
+                return
+            self.running = True
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+            self.thread = threading.Thread(target=self.run,
+                                           name='hs602-watchdog',
+                                           daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop watching."""
+        with self.cond:
+            self.running = False
+            thread, self.thread = self.thread, None
+            self.cond.notify()
+        if thread and thread is not threading.current_thread():
+            thread.join()
+        if self.pool:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+    def stats(self):
+        """Device health and recovery times."""
+        with self.cond:
+            watches = list(self.watches.values())
+        recoveries = [ttr for watch in watches
+                      for ttr in watch.recoveries]
+        return {
+            'devices': len(watches),
+            'down': sum(1 for watch in watches if watch.down),
+            'restarts': sum(watch.restarts for watch in watches),
+            'recoveries': len(recoveries),
+            'recovery_mean': (sum(recoveries) / len(recoveries)
+                              if recoveries else None),
+            'recovery_max': max(recoveries) if recoveries else None,
+        }
@@ -31,6 +31,7 @@ setup(
     entry_points={
         'console_scripts': [
             'hs602-example=hs602.example:main',
+            'hs602-gateway=hs602.gateway:main',
         ]
     },
     install_requires=[''],
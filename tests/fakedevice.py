@@ -0,0 +1,188 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import socket
+import socketserver
+import threading
+import time
+import unittest
+from hs602.controller import Controller
+
+
+class FakeDevice(object):
+    """Just enough of an HS602 command port to drive a Controller.
+
+    Answers every getter settings() reads, fps, mode and colours can be
+    set and other frames are echoed. Each reply can be delayed, hang
+    holds every reply until cleared and sessions idle longer than idle
+    are dropped.
+    """
+    def __init__(self, cmd_len=15, idle=None):
+        """
+        :param cmd_len: Command length - default 15.
+        :param idle: (optional) Seconds before an idle session is
+        dropped.
+        """
+        self.cmd_len = cmd_len
+        self.idle = idle
+        self.connections = 0
+        self.strings = {16: 'rtmp://example/live', 17: 'key',
+                        20: 'user', 21: 'password', 23: 'channel'}
+        self.colours = [128, 128, 128, 128]
+        self.streaming = True
+        self.fps = 30
+        self.mode = 0
+        self.delay = 0
+        self.hang = threading.Event()
+        self.frames = 0
+        # Command id and get flag of each frame.
+        self.log = list()
+
+        device = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                device.connections += 1
+                self.request.settimeout(device.idle)
+                buf = bytes()
+                while True:
+                    try:
+                        data = self.request.recv(1024)
+                    except socket.timeout:
+                        try:
+                            self.request.shutdown(socket.SHUT_RDWR)
+                        except OSError:
+                            pass
+                        return
+                    except OSError:
+                        return
+                    if not data:
+                        return
+                    buf += data
+                    # Getters may send short frames.
+                    while buf:
+                        frame = buf[:device.cmd_len]
+                        frame = frame.ljust(device.cmd_len, b'\0')
+                        buf = buf[device.cmd_len:]
+                        try:
+                            self.request.sendall(device.reply(frame))
+                        except OSError:
+                            return
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """Stop serving, releases hung replies."""
+        self.hang.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def out(self, values):
+        """Padded reply.
+
+        :param values: Reply bytes.
+        """
+        return bytes(values).ljust(self.cmd_len, b'\0')
+
+    def reply(self, frame):
+        """Reply to a frame.
+
+        :param frame: Command frame.
+        """
+        self.frames += 1
+        self.log.append((frame[0], frame[1]))
+        while self.hang.is_set():
+            time.sleep(0.01)
+        if self.delay:
+            time.sleep(self.delay)
+        cmd, get = frame[0], frame[1]
+        if cmd in self.strings and get:
+            value = self.strings[cmd]
+            pos = frame[2]
+            return self.out([ord(value[pos])] if pos < len(value) else [0])
+        if cmd == 15 and get:
+            return self.out([int(self.streaming)])
+        if cmd == 19 and get:
+            return self.out([self.fps])
+        if cmd == 19:
+            self.fps = frame[2]
+        if cmd == 8 and get:
+            return self.out([self.mode])
+        if cmd == 8:
+            self.mode = frame[2]
+        if cmd == 10 and get:
+            return self.out([self.colours[frame[2]]])
+        if cmd == 10:
+            self.colours[frame[2]] = frame[3]
+        # HDMI, 1920x1080 60Hz input, no picture size.
+        if cmd == 1 and get:
+            return self.out([3])
+        if cmd == 4 and get:
+            return self.out([0])
+        if cmd == 3 and get:
+            return self.out([0] * 8)
+        if cmd == 56 and get:
+            return self.out([1, 2, 3])
+        # Sets and keepalive are echoed.
+        return frame
+
+
+class ControllerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.device = FakeDevice()
+        # Nothing listens for the knock, it only needs to be sent.
+        self.controller = Controller('127.0.0.1', tcp=self.device.port,
+                                     timeout=5)
+        self.threads = list()
+
+    def tearDown(self):
+        self.device.close()
+        for thread in self.threads:
+            thread.join(10)
+        self.controller.shutdown()
+
+    def background(self, func, *args, **kwargs):
+        """Run func on a thread, returns a dict of its result or error.
+
+        :param func: Callable.
+        """
+        result = dict()
+
+        def run():
+            started = time.monotonic()
+            try:
+                result['value'] = func(*args, **kwargs)
+            except Exception as exc:
+                result['error'] = exc
+            result['elapsed'] = time.monotonic() - started
+        thread = threading.Thread(target=run, daemon=True)
+        self.threads.append(thread)
+        thread.start()
+        return result
+
+    def join(self):
+        """Wait for the background threads."""
+        for thread in self.threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
@@ -0,0 +1,118 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import socket
+import unittest
+from hs602.adaptive import Adaptive, Meter
+
+
+def packet(seq, ssrc=1):
+    """RTP header carrying a sequence number.
+
+    :param seq: Sequence number.
+    :param ssrc: Stream source.
+    """
+    return (bytes([0x80, 33]) + (seq & 0xffff).to_bytes(2, 'big') +
+            bytes(4) + ssrc.to_bytes(4, 'big'))
+
+
+class FakeController(object):
+    """Controller stand-in that records bitrate sets."""
+    def __init__(self, bitrate=8000):
+        self.value = bitrate
+        self.sets = list()
+
+    def bitrate(self, new_value=None):
+        if new_value is not None:
+            self.value = new_value
+            self.sets.append(new_value)
+        return self.value
+
+
+class FixedMeter(object):
+    """Meter stand-in returning a fixed sample."""
+    def __init__(self, kbps, loss):
+        self.kbps = kbps
+        self.loss = loss
+
+    def sample(self):
+        return self.kbps, self.loss
+
+
+class MeterTest(unittest.TestCase):
+    def feed(self, seqs, **kwargs):
+        meter = Meter()
+        for seq in seqs:
+            meter.feed(packet(seq, **kwargs))
+        return meter.sample()[1]
+
+    def test_loss(self):
+        self.assertEqual(self.feed([1, 2, 3, 4]), 0)
+        self.assertEqual(self.feed([1, 3, 4]), 0.25)
+
+    def test_reordered_not_lost(self):
+        self.assertEqual(self.feed([1, 3, 2, 4]), 0)
+        self.assertEqual(self.feed([65534, 1, 65535, 0, 2]), 0)
+        # Duplicates of a late packet don't take back more.
+        self.assertEqual(self.feed([1, 4, 2, 2, 5]), 0.2)
+
+    def test_restart(self):
+        meter = Meter()
+        for seq in range(100, 110):
+            meter.feed(packet(seq))
+        for seq in range(40000, 40010):
+            meter.feed(packet(seq, ssrc=2))
+        self.assertEqual(meter.sample()[1], 0)
+
+    def test_close(self):
+        meter = Meter()
+        meter.listen(port=0, timeout=0.05)
+        sock = meter.sock
+        port = sock.getsockname()[1]
+        meter.close()
+        meter.thread.join(1)
+        self.assertEqual(sock.fileno(), -1)
+        rebind = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rebind.bind(('', port))
+        rebind.close()
+
+
+class AdaptiveTest(unittest.TestCase):
+    def adaptive(self, kbps, loss):
+        controller = FakeController()
+        adaptive = Adaptive(controller, FixedMeter(kbps, loss),
+                            cooldown=0)
+        for tick in range(3):
+            adaptive.tick()
+        return controller.sets
+
+    def test_steps_down_on_loss(self):
+        self.assertEqual(self.adaptive(8000, 0.05), [6000])
+
+    def test_vbr_under_delivery_holds(self):
+        # A static scene sends well under the average without loss.
+        self.assertEqual(self.adaptive(1000, 0), [])
+
+    def test_steps_up_when_good(self):
+        controller = FakeController()
+        adaptive = Adaptive(controller, FixedMeter(8000, 0), cooldown=0)
+        for tick in range(5):
+            adaptive.tick()
+        self.assertEqual(controller.sets, [8800])
+
+
+if __name__ == '__main__':
+    unittest.main()
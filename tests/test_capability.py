@@ -0,0 +1,99 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import json
+import os
+import tempfile
+import threading
+import unittest
+from hs602.capability import Capabilities
+
+
+class FakeController(object):
+    """Controller stand-in that only knows its firmware."""
+    def __init__(self, addr, firmware='1.2.3', tcp=8087):
+        self.addr = addr
+        self.tcp = tcp
+        self.version = firmware
+        self.reads = 0
+
+    def firmware(self):
+        self.reads += 1
+        return self.version
+
+
+class CapabilitiesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'hs602',
+                                 'capabilities.json')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_probe(self):
+        caps = Capabilities()
+        self.assertFalse(caps.supports(FakeController('a', '56.1.0'),
+                                       'name'))
+        self.assertTrue(caps.supports(FakeController('b', '57.0.0'),
+                                      'name'))
+        self.assertTrue(caps.supports(FakeController('c'), 'unknown'))
+
+    def test_cached_on_disk(self):
+        controller = FakeController('a', '56.1.0')
+        self.assertFalse(Capabilities(self.path).supports(controller,
+                                                          'name'))
+        self.assertFalse(Capabilities(self.path).supports(controller,
+                                                          'name'))
+        self.assertEqual(controller.reads, 1)
+
+    def test_concurrent_supports(self):
+        caps = Capabilities(self.path)
+        errors = list()
+
+        def run(index):
+            try:
+                caps.supports(FakeController('device{}'.format(index)),
+                              'name')
+            except Exception as exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=run, args=(index,))
+                   for index in range(200)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        with open(self.path) as src:
+            self.assertTrue(json.load(src)['devices'])
+        # No temporary files are left behind.
+        self.assertEqual(os.listdir(os.path.dirname(self.path)),
+                         ['capabilities.json'])
+
+    def test_unwritable_path(self):
+        # A file where the cache directory should be.
+        blocker = os.path.join(self.tmp.name, 'blocker')
+        open(blocker, 'w').close()
+        caps = Capabilities(os.path.join(blocker, 'capabilities.json'))
+        controller = FakeController('a', '56.1.0')
+        self.assertFalse(caps.supports(controller, 'name'))
+        # Still cached in memory.
+        self.assertFalse(caps.supports(controller, 'name'))
+        self.assertEqual(controller.reads, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
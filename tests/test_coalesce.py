@@ -0,0 +1,62 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import time
+import unittest
+from fakedevice import ControllerTestCase
+
+
+class CoalescerTest(ControllerTestCase):
+    def colour_sets(self):
+        return [frame for frame in self.device.log if frame == (10, 0)]
+
+    def test_collapses_sets(self):
+        futures = [self.controller.coalesce().brightness(value)
+                   for value in range(50)]
+        self.assertTrue(self.controller.coalesce().flush(5))
+        for future in futures:
+            self.assertEqual(future.result(), 49)
+        self.assertEqual(self.device.colours[0], 49)
+        self.assertEqual(len(self.colour_sets()), 1)
+
+    def test_one_coalescer(self):
+        coalescer = self.controller.coalesce()
+        self.assertIs(self.controller.coalesce(), coalescer)
+        coalescer.hue(7).result(5)
+        # Still the same one after the session is reconnected.
+        self.controller.disconnect()
+        self.assertEqual(self.controller.hue(), 7)
+        self.assertIs(self.controller.coalesce(), coalescer)
+
+    def test_writer_exits_when_idle(self):
+        self.controller.coalesce().contrast(9).result(5)
+        time.sleep(0.1)
+        self.assertIsNone(self.controller.coalesce().thread)
+        self.assertEqual(self.controller.coalesce().saturation(3).result(5),
+                         3)
+
+    def test_shutdown_writes_pending(self):
+        coalescer = self.controller.coalesce(window=1)
+        future = coalescer.brightness(5)
+        self.controller.shutdown()
+        self.assertEqual(future.result(5), 5)
+        self.assertIsNot(self.controller.coalesce(), coalescer)
+        with self.assertRaises(Exception):
+            coalescer.brightness(6)
+
+
+if __name__ == '__main__':
+    unittest.main()
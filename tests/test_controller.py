@@ -0,0 +1,83 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import threading
+import time
+import unittest
+from hs602.deadline import Deadline, DeadlineExceeded
+from fakedevice import ControllerTestCase
+
+
+class DeadlineTest(ControllerTestCase):
+    def test_getter(self):
+        self.assertEqual(self.controller.fps(), 30)
+        self.assertEqual(self.controller.fps(25), 25)
+        self.assertEqual(self.controller.fps(), 25)
+        self.assertEqual(self.controller.url(), 'rtmp://example/live')
+
+    def test_expires_waiting_for_session(self):
+        self.controller.keepalive()
+        self.device.hang.set()
+        # Holds the session until the device replies.
+        self.background(self.controller.fps)
+        time.sleep(0.1)
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded) as ctx:
+            self.controller.url(deadline=0.3)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertFalse(ctx.exception.cancelled)
+        self.device.hang.clear()
+
+    def test_expires_with_partial(self):
+        self.device.strings[16] = 'rtmp://' + 'x' * 60
+        self.device.delay = 0.01
+        with self.assertRaises(DeadlineExceeded) as ctx:
+            self.controller.url(deadline=0.2)
+        partial = ctx.exception.partial
+        self.assertTrue(self.device.strings[16].startswith(partial))
+        self.assertLess(len(partial), len(self.device.strings[16]))
+
+    def test_cancel_waiting_on_device(self):
+        self.controller.keepalive()
+        self.device.hang.set()
+        deadline = Deadline(5)
+        threading.Timer(0.2, deadline.cancel).start()
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded) as ctx:
+            self.controller.url(deadline=deadline)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertTrue(ctx.exception.cancelled)
+        self.device.hang.clear()
+        # The session is reopened for the next command.
+        self.assertEqual(self.controller.fps(), 30)
+
+    def test_cancel_waiting_for_session(self):
+        self.controller.keepalive()
+        self.device.hang.set()
+        self.background(self.controller.fps)
+        time.sleep(0.1)
+        deadline = Deadline(5)
+        threading.Timer(0.2, deadline.cancel).start()
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded) as ctx:
+            self.controller.url(deadline=deadline)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertTrue(ctx.exception.cancelled)
+        self.device.hang.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
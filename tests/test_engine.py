@@ -0,0 +1,74 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import time
+import unittest
+from hs602.engine import Engine
+from fakedevice import FakeDevice
+
+
+class EngineTest(unittest.TestCase):
+    addr = '127.0.0.1'
+
+    def setUp(self):
+        self.device = FakeDevice(idle=0.3)
+        self.engine = Engine(tcp=self.device.port, timeout=2)
+
+    def tearDown(self):
+        self.engine.close()
+        self.device.close()
+
+    def test_operations(self):
+        results = self.engine.run({self.addr: [
+            'fps', ('fps', 25), 'fps', 'url', 'firmware', [19, 1],
+            'bogus', ('mode', 'nope')]})[self.addr]
+        self.assertEqual(results[:5],
+                         [30, 25, 25, 'rtmp://example/live', '1.2.3'])
+        # Raw messages get the raw reply.
+        self.assertEqual(results[5][0], 25)
+        # A bad operation fails on its own.
+        self.assertIsInstance(results[6], KeyError)
+        self.assertIsInstance(results[7], ValueError)
+
+    def test_reuse_session(self):
+        self.assertEqual(self.engine.run({self.addr: ['fps']}),
+                         {self.addr: [30]})
+        self.assertEqual(self.engine.run({self.addr: []}),
+                         {self.addr: []})
+        results = self.engine.run({self.addr: [('base_port', 70000)]})
+        self.assertIsInstance(results[self.addr][0], Exception)
+        self.assertEqual(self.engine.run({self.addr: ['fps']}),
+                         {self.addr: [30]})
+        self.assertEqual(self.device.connections, 1)
+
+    def test_reconnect_dropped_session(self):
+        self.assertEqual(self.engine.run({self.addr: ['fps']}),
+                         {self.addr: [30]})
+        # The device drops the idle session.
+        time.sleep(0.5)
+        self.assertEqual(self.engine.run({self.addr: ['fps', 'url']}),
+                         {self.addr: [30, 'rtmp://example/live']})
+        self.assertEqual(self.device.connections, 2)
+
+    def test_broadcast(self):
+        results = self.engine.broadcast([self.addr, 'localhost'],
+                                        ['fps', 'streaming'])
+        self.assertEqual(results, {self.addr: [30, True],
+                                   'localhost': [30, True]})
+
+
+if __name__ == '__main__':
+    unittest.main()
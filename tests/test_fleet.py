@@ -0,0 +1,65 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import time
+import unittest
+from hs602.fleet import Fleet
+from fakedevice import FakeDevice
+
+
+class FleetTest(unittest.TestCase):
+    addr = '127.0.0.1'
+
+    def setUp(self):
+        self.device = FakeDevice(idle=0.5)
+
+    def tearDown(self):
+        self.device.close()
+
+    def fleet(self, **kwargs):
+        fleet = Fleet(processes=2, tcp=self.device.port, timeout=2,
+                      **kwargs)
+        self.addCleanup(fleet.close)
+        return fleet
+
+    def test_run(self):
+        fleet = self.fleet()
+        results = fleet.run([(self.addr, 'fps'),
+                             (self.addr, 'fps', (25,)),
+                             (self.addr, '_settings'),
+                             (self.addr, 'url')], timeout=5)
+        self.assertEqual(results[0], (True, 30))
+        self.assertEqual(results[1], (True, 25))
+        # Only whitelisted methods are called, the rest still run.
+        self.assertFalse(results[2][0])
+        self.assertEqual(results[3], (True, 'rtmp://example/live'))
+        self.assertEqual(fleet.call(self.addr, 'firmware'), '1.2.3')
+
+    def test_idle_sessions_kept_alive(self):
+        fleet = self.fleet(keepalive=0.2)
+        self.assertEqual(fleet.call(self.addr, 'fps'), 30)
+        # Longer than the device keeps an idle session.
+        time.sleep(1.5)
+        results = fleet.run([(self.addr, 'fps'), (self.addr, 'url'),
+                             (self.addr, 'streaming')], timeout=5)
+        self.assertEqual(results, [(True, 30),
+                                   (True, 'rtmp://example/live'),
+                                   (True, True)])
+        self.assertEqual(self.device.connections, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import threading
+import time
+import unittest
+from unittest import mock
+from hs602 import controller
+from hs602.deadline import DeadlineExceeded
+from hs602.flight import Flight
+from fakedevice import ControllerTestCase
+
+
+class FlightTest(ControllerTestCase):
+    def setUp(self):
+        super().setUp()
+        # About half a second to read.
+        self.url = 'rtmp://' + 'x' * 43
+        self.device.strings[16] = self.url
+        self.device.delay = 0.01
+        self.controller.keepalive()
+
+    def test_leader_deadline_spares_joiner(self):
+        leader = self.background(self.controller.url, deadline=0.2)
+        time.sleep(0.05)
+        joiner = self.background(self.controller.url)
+        self.join()
+        self.assertIsInstance(leader.get('error'), DeadlineExceeded)
+        self.assertEqual(joiner.get('value'), self.url)
+
+    def test_joiner_keeps_own_deadline(self):
+        leader = self.background(self.controller.url)
+        time.sleep(0.05)
+        joiner = self.background(self.controller.url, deadline=0.1)
+        self.join()
+        self.assertEqual(leader.get('value'), self.url)
+        self.assertIsInstance(joiner.get('error'), DeadlineExceeded)
+        self.assertLess(joiner['elapsed'], 0.3)
+
+    def test_joiners_share_read(self):
+        before = self.device.frames
+        readers = [self.background(self.controller.url) for i in range(4)]
+        self.join()
+        for reader in readers:
+            self.assertEqual(reader.get('value'), self.url)
+        # One read of the string and its terminator.
+        self.assertEqual(self.device.frames - before, len(self.url) + 1)
+
+
+class BarrierTest(ControllerTestCase):
+    def test_read_after_set_sees_new_value(self):
+        self.device.strings[16] = 'rtmp://' + 'x' * 100
+        self.device.delay = 0.005
+        self.controller.keepalive()
+        fps_op = controller.fps_op
+        readers = list()
+
+        def racing_fps_op(cmd_len=15, new_value=None):
+            # A settings() read starts once the setter has begun and
+            # reads fps before it's written.
+            if new_value is not None:
+                readers.append(self.background(self.controller.settings))
+                while (19, 1) not in self.device.log:
+                    time.sleep(0.005)
+            return (yield from fps_op(cmd_len, new_value))
+
+        with mock.patch('hs602.controller.fps_op', racing_fps_op):
+            self.assertEqual(self.controller.fps(25), 25)
+        # The racing read is still going, this one mustn't join it.
+        read_only, modifiable = self.controller.settings()
+        self.assertEqual(modifiable['fps'], 25)
+        self.join()
+        self.assertEqual(readers[0]['value'][1]['fps'], 30)
+
+    def test_colour_setter(self):
+        self.assertEqual(self.controller.brightness(), 128)
+        self.assertEqual(self.controller.brightness(7), 7)
+        self.assertEqual(self.controller.settings()[1]['brightness'], 7)
+
+
+class FlightUnitTest(unittest.TestCase):
+    def test_error_shared(self):
+        flight = Flight()
+        started = threading.Event()
+
+        def fail():
+            started.set()
+            time.sleep(0.1)
+            raise ValueError('boom')
+        errors = list()
+
+        def call():
+            try:
+                flight.do('key', fail)
+            except ValueError as exc:
+                errors.append(exc)
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        joiner = threading.Thread(target=call)
+        joiner.start()
+        leader.join()
+        joiner.join()
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+        self.assertEqual(flight.calls, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
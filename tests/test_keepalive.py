@@ -0,0 +1,81 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import time
+import unittest
+from hs602.controller import Controller
+from hs602.keepalive import Scheduler
+from fakedevice import FakeDevice
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.devices = list()
+
+    def tearDown(self):
+        for device in self.devices:
+            device.close()
+
+    def controller(self):
+        device = FakeDevice()
+        self.devices.append(device)
+        return device, Controller('127.0.0.1', tcp=device.port, timeout=2)
+
+    def test_keeps_alive(self):
+        scheduler = Scheduler(interval=0.1, jitter=0)
+        device, controller = self.controller()
+        session = scheduler.add(controller)
+        scheduler.start()
+        time.sleep(0.55)
+        scheduler.stop()
+        self.assertGreaterEqual(session.sent, 3)
+        self.assertEqual(session.missed, 0)
+        self.assertEqual(device.log.count((0, 0)), session.sent)
+
+    def test_dead_device_doesnt_stall_others(self):
+        scheduler = Scheduler(interval=0.2, jitter=0)
+        dead_device, dead = self.controller()
+        dead_device.hang.set()
+        healthy_device, healthy = self.controller()
+        dead_session = scheduler.add(dead)
+        healthy_session = scheduler.add(healthy)
+        scheduler.start()
+        time.sleep(1.1)
+        dead_device.hang.clear()
+        scheduler.stop()
+        self.assertGreaterEqual(healthy_session.sent, 4)
+        self.assertEqual(healthy_session.missed, 0)
+        self.assertGreater(dead_session.missed, 0)
+
+    def test_late_failure_is_one_miss(self):
+        missed = list()
+        scheduler = Scheduler(interval=1, grace=0.1, workers=0,
+                              missed=lambda session, exc: missed.append(
+                                  exc))
+        device, controller = self.controller()
+        session = scheduler.add(controller)
+        device.close()
+        # Late and the device is gone.
+        session.due = time.monotonic() - 1
+        scheduler.keep(session)
+        self.assertEqual(session.missed, 1)
+        self.assertEqual(len(missed), 1)
+        self.assertIsNotNone(missed[0])
+        controller.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import threading
+import time
+import unittest
+from hs602.priority import BULK, CONTROL, TELEMETRY, PriorityLock
+from fakedevice import ControllerTestCase
+
+
+class PriorityTest(ControllerTestCase):
+    def test_control_overtakes_bulk(self):
+        self.device.strings[16] = 'rtmp://' + 'x' * 150
+        self.device.delay = 0.005
+        self.controller.keepalive()
+        bulk = self.background(self.controller.url)
+        time.sleep(0.1)
+        latency = list()
+        for i in range(5):
+            started = time.monotonic()
+            self.assertTrue(self.controller.streaming())
+            latency.append(time.monotonic() - started)
+            time.sleep(0.02)
+        self.join()
+        self.assertEqual(bulk.get('value'), self.device.strings[16])
+        # A frame or two, not the rest of the string.
+        self.assertLess(max(latency), 0.1)
+        stats = self.controller.wire.stats()
+        self.assertGreaterEqual(stats['control']['acquired'], 5)
+
+
+class PriorityLockTest(unittest.TestCase):
+    def test_most_urgent_first(self):
+        lock = PriorityLock()
+        order = list()
+        lock.acquire(BULK)
+
+        def wait(priority):
+            with lock.hold(priority):
+                order.append(priority)
+        threads = list()
+        for priority in (BULK, TELEMETRY, CONTROL):
+            threads.append(threading.Thread(target=wait, args=(priority,)))
+            threads[-1].start()
+            time.sleep(0.05)
+        lock.release()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, [CONTROL, TELEMETRY, BULK])
+
+    def test_timeout_and_cancel(self):
+        lock = PriorityLock()
+        holder = threading.Thread(target=lock.acquire)
+        holder.start()
+        holder.join()
+        started = time.monotonic()
+        self.assertFalse(lock.acquire(CONTROL, timeout=0.1))
+        self.assertLess(time.monotonic() - started, 0.5)
+        cancel = threading.Event()
+        threading.Timer(0.1, lambda: (cancel.set(), lock.wake())).start()
+        self.assertFalse(lock.acquire(CONTROL, cancelled=cancel.is_set))
+        # Waiters that gave up are gone.
+        self.assertEqual(lock.waiters, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
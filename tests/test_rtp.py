@@ -0,0 +1,127 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import socket
+import time
+import unittest
+from hs602.rtp import Receiver, Reorder
+
+
+def packet(seq, ssrc=1):
+    """RTP packet carrying its sequence number.
+
+    :param seq: Sequence number.
+    :param ssrc: Stream source.
+    """
+    buf = bytearray(2048)
+    buf[:12] = bytes([0x80, 33]) + (seq & 0xffff).to_bytes(2, 'big') + \
+        bytes(4) + ssrc.to_bytes(4, 'big')
+    return buf
+
+
+class ReorderTest(unittest.TestCase):
+    def reorder(self, **kwargs):
+        self.out = list()
+        return Reorder(lambda buf, length: self.out.append(
+            buf[2] << 8 | buf[3]), **kwargs)
+
+    def feed(self, reorder, seqs, now=0, **kwargs):
+        for seq in seqs:
+            reorder.push(packet(seq, **kwargs), 12, now)
+
+    def test_in_order(self):
+        reorder = self.reorder()
+        self.feed(reorder, range(10))
+        self.assertEqual(self.out, list(range(10)))
+        self.assertEqual(reorder.stats()['lost'], 0)
+
+    def test_reordered(self):
+        reorder = self.reorder()
+        self.feed(reorder, [1, 3, 2, 5, 4, 6])
+        self.assertEqual(self.out, [1, 2, 3, 4, 5, 6])
+        stats = reorder.stats()
+        self.assertEqual(stats['lost'], 0)
+        self.assertEqual(stats['reordered'], 2)
+
+    def test_gap_expires(self):
+        reorder = self.reorder(delay=0.05)
+        self.feed(reorder, [1, 3, 4])
+        self.assertEqual(self.out, [1])
+        reorder.expire(1)
+        self.assertEqual(self.out, [1, 3, 4])
+        self.assertEqual(reorder.stats()['lost'], 1)
+        # Too late.
+        self.feed(reorder, [2])
+        self.assertEqual(reorder.stats()['late'], 1)
+
+    def test_wrap(self):
+        # 500 doesn't divide the sequence space.
+        for slots in (500, 512):
+            reorder = self.reorder(slots=slots)
+            seqs = [(65500 + seq) & 0xffff for seq in range(100)]
+            swapped = list(seqs)
+            for index in range(1, len(swapped) - 1, 2):
+                swapped[index], swapped[index + 1] = (swapped[index + 1],
+                                                      swapped[index])
+            self.feed(reorder, swapped)
+            self.assertEqual(self.out, seqs)
+            self.assertEqual(reorder.stats()['lost'], 0)
+
+    def test_wrap_gap(self):
+        reorder = self.reorder(slots=500)
+        self.feed(reorder, [65530, 65532, 32])
+        self.assertEqual(self.out, [65530])
+        reorder.flush()
+        self.assertEqual(self.out, [65530, 65532, 32])
+
+    def test_restart(self):
+        reorder = self.reorder()
+        self.feed(reorder, range(100, 110))
+        # New stream, new sequence and SSRC.
+        self.feed(reorder, range(40000, 40010), ssrc=2)
+        self.assertEqual(self.out, list(range(100, 110)) +
+                         list(range(40000, 40010)))
+        stats = reorder.stats()
+        self.assertEqual(stats['lost'], 0)
+        self.assertEqual(stats['resyncs'], 1)
+
+
+class ReceiverTest(unittest.TestCase):
+    def test_stream(self):
+        out = list()
+        receiver = Receiver(lambda buf, length: out.append(
+            buf[2] << 8 | buf[3]), port=0, host='127.0.0.1', delay=0.01)
+        receiver.start()
+        port = receiver.sock.getsockname()[1]
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for seq in (1, 3, 2, 4):
+            sender.sendto(bytes(packet(seq)[:12]), ('127.0.0.1', port))
+        sender.close()
+        ends = time.monotonic() + 2
+        while len(out) < 4 and time.monotonic() < ends:
+            time.sleep(0.01)
+        sock = receiver.sock
+        receiver.stop()
+        self.assertEqual(out, [1, 2, 3, 4])
+        # Closed, and the port is free again.
+        self.assertEqual(sock.fileno(), -1)
+        rebind = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rebind.bind(('127.0.0.1', port))
+        rebind.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# Copyright (C) 2019 Mark Clarkstone <mpmc@disroot.org>
+#
+# This file is part of hs602.
+#
+# hs602 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hs602 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hs602.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+from hs602.state import DeviceState
+
+SETTINGS = (
+    {'firmware': '1.2.3', 'resolution': '1920x1080 60Hz',
+     'clients': (1, 2), 'hdcp': False},
+    {'mode': 'unicast', 'fps': 30, 'streaming': True, 'bitrate': 8000,
+     'picture': '1920,1080', 'saturation': 128, 'hue': 128,
+     'contrast': 128, 'brightness': 128, 'username': 'user',
+     'password': 'password', 'key': 'key', 'url': 'rtmp://example/live',
+     'name': 'channel', 'source': 'hdmi'},
+)
+
+
+class DeviceStateTest(unittest.TestCase):
+    def test_from_settings(self):
+        state = DeviceState.from_settings(SETTINGS)
+        self.assertEqual(state.picture, (1920, 1080))
+        self.assertEqual(state.clients, (1, 2))
+        self.assertIs(state.streaming, True)
+
+    def test_round_trip(self):
+        state = DeviceState.from_settings(SETTINGS)
+        self.assertEqual(DeviceState.from_bytes(state.to_bytes()), state)
+        self.assertEqual(DeviceState.from_json(state.to_json()), state)
+
+    def test_unknown_fields(self):
+        state = DeviceState(fps=25, url='rtmp://example/live')
+        decoded = DeviceState.from_bytes(state.to_bytes())
+        self.assertEqual(decoded, state)
+        self.assertIsNone(decoded.bitrate)
+
+    def test_long_strings(self):
+        # RTMP values are up to 255 characters of chr(0-255), more than
+        # 255 bytes of utf-8.
+        url = ''.join(chr(128 + pos % 128) for pos in range(255))
+        state = DeviceState(url=url, key='k' * 255)
+        self.assertEqual(DeviceState.from_bytes(state.to_bytes()).url, url)
+
+    def test_diff(self):
+        state = DeviceState.from_settings(SETTINGS)
+        other = DeviceState.from_settings(SETTINGS)
+        other.fps = 25
+        self.assertEqual(state.diff(other), {'fps': (30, 25)})
+
+    def test_not_a_state(self):
+        data = bytearray(DeviceState(fps=25).to_bytes())
+        data[4] += 1
+        with self.assertRaises(ValueError):
+            DeviceState.from_bytes(data)
+        with self.assertRaises(ValueError):
+            DeviceState(mode='multicast')
+
+
+if __name__ == '__main__':
+    unittest.main()